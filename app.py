@@ -1,11 +1,28 @@
-from flask import Flask, render_template, request, redirect, url_for, flash, jsonify, send_from_directory
+from flask import Flask, render_template, request, redirect, url_for, flash, jsonify, send_from_directory, Response, stream_with_context
 from flask_sqlalchemy import SQLAlchemy
+from sqlalchemy.dialects import mysql, postgresql, sqlite
+from sqlalchemy.exc import IntegrityError
 from flask_login import LoginManager, UserMixin, login_user, login_required, logout_user, current_user
 from werkzeug.security import generate_password_hash, check_password_hash
 from werkzeug.utils import secure_filename
-from datetime import datetime
+from datetime import datetime, timedelta
+from contextlib import contextmanager
+from email.message import EmailMessage
+import atexit
+import base64
+import json
+import math
 import os
+import queue
 import re
+import signal
+import smtplib
+import threading
+import time
+import traceback
+import unicodedata
+import uuid
+import click
 from dotenv import load_dotenv
 
 load_dotenv()
@@ -17,6 +34,50 @@ app.config['SQLALCHEMY_TRACK_MODIFICATIONS'] = False
 app.config['UPLOAD_FOLDER'] = 'uploads'
 app.config['MAX_CONTENT_LENGTH'] = 16 * 1024 * 1024  # 16MB max file size
 
+# Background job settings
+app.config['JOB_WORKER_THREADS'] = int(os.getenv('JOB_WORKER_THREADS', 2))
+app.config['JOB_MAX_ATTEMPTS'] = int(os.getenv('JOB_MAX_ATTEMPTS', 5))
+app.config['JOB_RETRY_DELAY'] = int(os.getenv('JOB_RETRY_DELAY', 5))  # seconds, doubled per attempt
+app.config['JOB_LEASE_SECONDS'] = int(os.getenv('JOB_LEASE_SECONDS', 300))
+app.config['JOB_POLL_INTERVAL'] = float(os.getenv('JOB_POLL_INTERVAL', 1.0))
+
+# Notification stream settings
+app.config['NOTIFICATION_STREAM_KEEPALIVE'] = int(os.getenv('NOTIFICATION_STREAM_KEEPALIVE', 25))  # seconds
+app.config['NOTIFICATION_LONG_POLL_MAX'] = int(os.getenv('NOTIFICATION_LONG_POLL_MAX', 30))  # seconds a count request may wait
+
+# Notification retention (0 disables a rule)
+app.config['NOTIFICATION_RETENTION_DAYS'] = int(os.getenv('NOTIFICATION_RETENTION_DAYS', 90))  # delete read notifications
+app.config['NOTIFICATION_ARCHIVE_DAYS'] = int(os.getenv('NOTIFICATION_ARCHIVE_DAYS', 365))  # archive everything older
+app.config['NOTIFICATION_PRUNE_BATCH'] = int(os.getenv('NOTIFICATION_PRUNE_BATCH', 500))
+app.config['NOTIFICATION_PRUNE_PAUSE'] = float(os.getenv('NOTIFICATION_PRUNE_PAUSE', 0.05))  # seconds between batches
+
+# Mark a ticket's notifications read when the recipient opens the ticket
+app.config['NOTIFICATION_AUTO_READ_ON_VIEW'] = os.getenv('NOTIFICATION_AUTO_READ_ON_VIEW', 'False').lower() == 'true'
+
+# Email settings
+app.config['MAIL_ENABLED'] = os.getenv('MAIL_ENABLED', 'False').lower() == 'true'
+app.config['MAIL_SERVER'] = os.getenv('MAIL_SERVER', 'smtp.gmail.com')
+app.config['MAIL_PORT'] = int(os.getenv('MAIL_PORT', 587))
+app.config['MAIL_USE_TLS'] = os.getenv('MAIL_USE_TLS', 'True').lower() == 'true'
+app.config['MAIL_USERNAME'] = os.getenv('MAIL_USERNAME')
+app.config['MAIL_PASSWORD'] = os.getenv('MAIL_PASSWORD')
+app.config['MAIL_DEFAULT_SENDER'] = os.getenv('MAIL_DEFAULT_SENDER', 'QuickDesk <noreply@quickdesk.com>')
+app.config['MAIL_POOL_SIZE'] = int(os.getenv('MAIL_POOL_SIZE', 2))  # open connections per server
+app.config['MAIL_MESSAGES_PER_CONNECTION'] = int(os.getenv('MAIL_MESSAGES_PER_CONNECTION', 100))
+app.config['MAIL_RATE_LIMIT'] = float(os.getenv('MAIL_RATE_LIMIT', 10))  # messages per second per server, 0 disables
+app.config['MAIL_BATCH_SIZE'] = int(os.getenv('MAIL_BATCH_SIZE', 100))  # messages per send job
+app.config['MAIL_TIMEOUT'] = int(os.getenv('MAIL_TIMEOUT', 30))  # seconds
+
+# Dashboard summary counts are cached this long, in seconds
+app.config['TICKET_STATS_TTL'] = int(os.getenv('TICKET_STATS_TTL', 30))
+
+# New tickets at least this similar (0-1) to an active one are flagged as likely duplicates
+app.config['TICKET_DUPLICATE_THRESHOLD'] = float(os.getenv('TICKET_DUPLICATE_THRESHOLD', 0.5))
+
+# Dashboard pages are cached this long, in seconds, and up to this many pages
+app.config['TICKET_PAGE_CACHE_TTL'] = int(os.getenv('TICKET_PAGE_CACHE_TTL', 60))
+app.config['TICKET_PAGE_CACHE_SIZE'] = int(os.getenv('TICKET_PAGE_CACHE_SIZE', 1000))
+
 # Ensure upload directory exists
 os.makedirs(app.config['UPLOAD_FOLDER'], exist_ok=True)
 
@@ -32,96 +93,1588 @@ def allowed_file(filename):
     return '.' in filename and \
            filename.rsplit('.', 1)[1].lower() in ALLOWED_EXTENSIONS
 
+# Keyset pagination cursors
+def encode_cursor(*values):
+    """Encode the sort key of the last row on a page as an opaque URL-safe token"""
+    values = [value.isoformat() if isinstance(value, datetime) else value for value in values]
+    return base64.urlsafe_b64encode(json.dumps(values).encode()).decode().rstrip('=')
+
+def decode_cursor(token, *types):
+    """Decode a cursor token into values of the given types; None if it is invalid"""
+    if not token:
+        return None
+    try:
+        values = json.loads(base64.urlsafe_b64decode(token + '=' * (-len(token) % 4)))
+        if len(values) != len(types):
+            return None
+        return tuple(
+            datetime.fromisoformat(value) if type_ is datetime else type_(value)
+            for type_, value in zip(types, values)
+        )
+    except (ValueError, TypeError):
+        return None
+
+class KeysetPage:
+    """One page of a keyset-paginated query and cursors to its neighbours"""
+    
+    def __init__(self, items, next_cursor=None, prev_cursor=None, total=None):
+        self.items = items
+        self.next_cursor = next_cursor
+        self.prev_cursor = prev_cursor
+        self.total = total
+
+def keyset_paginate(query, keys, cursor=None, per_page=10):
+    """Return a KeysetPage of query ordered by keys, starting after cursor
+
+    keys is a list of (expression, descending, type) whose last entries make
+    the order unique, such as the primary key. Each page is an index seek
+    past the previous page's last row rather than an OFFSET, so page 5,000
+    costs the same as page 1. Cursors record a direction, so pages can be
+    walked forwards ("after") and backwards ("before").
+    """
+    position = decode_cursor(cursor, str, *[type_ for _, _, type_ in keys])
+    backward = position is not None and position[0] == 'before'
+    
+    query = query.add_columns(*[expression.label(f'_key{i}') for i, (expression, _, _) in enumerate(keys)])
+    if position is not None:
+        values = position[1:]
+        if len({descending for _, descending, _ in keys}) == 1:
+            # One direction: a row-value comparison the database can seek on
+            columns = db.tuple_(*[expression for expression, _, _ in keys])
+            query = query.filter(columns < values if keys[0][1] != backward else columns > values)
+        else:
+            query = query.filter(db.or_(*[
+                db.and_(
+                    *[keys[j][0] == values[j] for j in range(i)],
+                    expression < values[i] if descending != backward else expression > values[i]
+                )
+                for i, (expression, descending, _) in enumerate(keys)
+            ]))
+    query = query.order_by(*[
+        expression.desc() if descending != backward else expression.asc()
+        for expression, descending, _ in keys
+    ])
+    
+    rows = query.limit(per_page + 1).all()
+    more = len(rows) > per_page
+    rows = rows[:per_page]
+    if backward:
+        rows.reverse()
+    if not rows:
+        return KeysetPage([])
+    
+    def key(row):
+        return row[1:]
+    
+    next_cursor = encode_cursor('after', *key(rows[-1])) if (more or backward) else None
+    prev_cursor = encode_cursor('before', *key(rows[0])) if (more if backward else position is not None) else None
+    return KeysetPage([row[0] for row in rows], next_cursor, prev_cursor)
+
+# Background jobs
+# Jobs live in the job table, so queued work survives restarts and needs no
+# external broker. Handlers run inside one transaction with the removal of
+# their job row, so a job's writes are committed exactly when it completes.
+JOB_HANDLERS = {}
+
+# Set whenever a job is queued so idle workers in this process wake up early
+_job_wakeup = threading.Event()
+
+def job_handler(name):
+    """Register a function as the handler for jobs called name"""
+    def decorator(func):
+        JOB_HANDLERS[name] = func
+        return func
+    return decorator
+
+def add_job(name, **payload):
+    """Add a job to the session; it is queued when the caller commits"""
+    job = Job(
+        name=name,
+        payload=json.dumps(payload),
+        max_attempts=app.config['JOB_MAX_ATTEMPTS']
+    )
+    db.session.add(job)
+    db.session.info['wake_job_workers'] = True
+    return job
+
+def enqueue_job(name, **payload):
+    """Queue a job to run in a background worker"""
+    job = add_job(name, **payload)
+    db.session.commit()
+    return job
+
+@db.event.listens_for(db.session, 'after_commit')
+def wake_job_workers(session):
+    if session.info.pop('wake_job_workers', False):
+        _job_wakeup.set()
+
+@db.event.listens_for(db.session, 'after_rollback')
+def discard_job_wakeup(session):
+    session.info.pop('wake_job_workers', None)
+
+def _claimable_job_filter(now):
+    return ((Job.status == 'queued') & (Job.run_at <= now)) | \
+           ((Job.status == 'running') & (Job.locked_until < now))
+
+def claim_job():
+    """Lease the next runnable job and return its id, or None if there is none"""
+    now = datetime.utcnow()
+    job_id = db.session.execute(
+        db.select(Job.id).where(_claimable_job_filter(now)).order_by(Job.run_at, Job.id).limit(1)
+    ).scalar()
+    if job_id is None:
+        db.session.rollback()
+        return None
+    
+    # Conditional update so only one worker wins the job, even across processes.
+    # An expired lease means the previous worker died, so the job is reclaimed.
+    result = db.session.execute(
+        db.update(Job)
+        .where(Job.id == job_id, _claimable_job_filter(now))
+        .values(
+            status='running',
+            attempts=Job.attempts + 1,
+            locked_until=now + timedelta(seconds=app.config['JOB_LEASE_SECONDS'])
+        )
+    )
+    db.session.commit()
+    return job_id if result.rowcount == 1 else None
+
+def run_job(job_id):
+    """Run a claimed job, scheduling a retry with backoff if it fails"""
+    job = db.session.get(Job, job_id)
+    if job is None:
+        # Deleted since it was claimed
+        return False
+    try:
+        handler = JOB_HANDLERS.get(job.name)
+        if handler is None:
+            raise LookupError(f'No handler registered for job {job.name!r}')
+        handler(**json.loads(job.payload))
+        db.session.delete(job)
+        db.session.commit()
+        return True
+    except Exception:
+        db.session.rollback()
+        error = traceback.format_exc()
+        app.logger.exception('Job %s (%s) failed', job_id, job.name)
+        
+        job = db.session.get(Job, job_id)
+        job.last_error = error
+        job.locked_until = None
+        if job.attempts >= job.max_attempts:
+            job.status = 'failed'
+        else:
+            job.status = 'queued'
+            delay = app.config['JOB_RETRY_DELAY'] * 2 ** (job.attempts - 1)
+            job.run_at = datetime.utcnow() + timedelta(seconds=delay)
+        db.session.commit()
+        return False
+
+def run_pending_jobs(limit=None):
+    """Run runnable jobs in the current thread until the queue is empty"""
+    processed = 0
+    while limit is None or processed < limit:
+        job_id = claim_job()
+        if job_id is None:
+            break
+        run_job(job_id)
+        processed += 1
+    return processed
+
+class JobWorker:
+    """Pool of threads that claim and run queued jobs until stopped"""
+    
+    def __init__(self, flask_app, threads=None, poll_interval=None):
+        self.app = flask_app
+        self.threads = threads or flask_app.config['JOB_WORKER_THREADS']
+        self.poll_interval = poll_interval or flask_app.config['JOB_POLL_INTERVAL']
+        self._stop = threading.Event()
+        self._threads = []
+    
+    def start(self):
+        for i in range(self.threads):
+            thread = threading.Thread(target=self._run, name=f'job-worker-{i}', daemon=True)
+            thread.start()
+            self._threads.append(thread)
+        return self
+    
+    def stop(self, timeout=None):
+        """Stop claiming new jobs and wait for running ones to finish"""
+        self._stop.set()
+        _job_wakeup.set()
+        for thread in self._threads:
+            thread.join(timeout)
+        self._threads = []
+    
+    def _run(self):
+        with self.app.app_context():
+            while not self._stop.is_set():
+                try:
+                    job_id = claim_job()
+                except Exception:
+                    db.session.rollback()
+                    self.app.logger.exception('Failed to claim a job')
+                    job_id = None
+                
+                if job_id is None:
+                    _job_wakeup.wait(self.poll_interval)
+                    _job_wakeup.clear()
+                    continue
+                # Recording a failure can itself fail (a locked database, say);
+                # the job's lease expires and it is claimed again, so log and go on
+                try:
+                    run_job(job_id)
+                except Exception:
+                    db.session.rollback()
+                    self.app.logger.exception('Failed to run job %s', job_id)
+                finally:
+                    db.session.remove()
+
+# Notification pub/sub
+class NotificationBroker:
+    """In-process pub/sub that pushes notification events to open streams"""
+    
+    def __init__(self, max_pending=100):
+        self.max_pending = max_pending
+        self._lock = threading.Lock()
+        self._subscribers = {}
+        self._roles = {}
+    
+    def subscribe(self, user_id, role=None):
+        subscription = queue.Queue(maxsize=self.max_pending)
+        with self._lock:
+            self._subscribers.setdefault(user_id, set()).add(subscription)
+            self._roles[user_id] = role
+        return subscription
+    
+    def unsubscribe(self, user_id, subscription):
+        with self._lock:
+            subscriptions = self._subscribers.get(user_id)
+            if subscriptions:
+                subscriptions.discard(subscription)
+                if not subscriptions:
+                    del self._subscribers[user_id]
+                    del self._roles[user_id]
+    
+    def publish(self, user_id, event):
+        with self._lock:
+            subscriptions = list(self._subscribers.get(user_id, ()))
+        self._deliver(subscriptions, event)
+    
+    def publish_to_roles(self, roles, event):
+        with self._lock:
+            subscriptions = [
+                subscription
+                for user_id, role in self._roles.items() if role in roles
+                for subscription in self._subscribers[user_id]
+            ]
+        self._deliver(subscriptions, event)
+    
+    def _deliver(self, subscriptions, event):
+        for subscription in subscriptions:
+            try:
+                subscription.put_nowait(event)
+            except queue.Full:
+                # A stalled stream only needs to know that something changed
+                pass
+
+notification_broker = NotificationBroker()
+
+def queue_notification_event(user_id, notification=None):
+    """Publish to user's streams after commit; None just signals a count change"""
+    db.session.info.setdefault('notification_events', []).append((user_id, notification))
+
+def queue_broadcast_event(roles, notification):
+    """Publish to the streams of every user in roles after commit"""
+    db.session.info.setdefault('broadcast_events', []).append((roles, notification))
+
+@db.event.listens_for(db.session, 'after_commit')
+def publish_committed_notifications(session):
+    """Publish notifications to open streams once their rows are committed"""
+    for user_id, event in session.info.pop('notification_events', []):
+        notification_broker.publish(user_id, event)
+    for roles, event in session.info.pop('broadcast_events', []):
+        notification_broker.publish_to_roles(roles, event)
+
+@db.event.listens_for(db.session, 'after_rollback')
+def discard_rolled_back_notifications(session):
+    session.info.pop('notification_events', None)
+    session.info.pop('broadcast_events', None)
+
+# Shared cache versions
+# A cache tagged with a version token is current while the token in the
+# cache_version table is unchanged. Tokens are random rather than counters so
+# a recreated database can never match a token cached before it. A token
+# only exists once the data has changed; until then callers don't cache.
+def cache_version(name):
+    """Return the current version token for the cache called name, or None"""
+    return db.session.execute(
+        db.select(CacheVersion.token).where(CacheVersion.name == name)
+    ).scalar()
+
+def bump_cache_version(name):
+    """Invalidate the cache called name in every process; the caller commits"""
+    token = uuid.uuid4().hex
+    result = db.session.execute(
+        db.update(CacheVersion.__table__).where(CacheVersion.name == name).values(token=token)
+    )
+    if not result.rowcount:
+        insert_ignore(CacheVersion, [{'name': name, 'token': token}])
+
+# Role membership cache
+_role_members = {'version': None, 'roles': {}}
+_role_members_lock = threading.Lock()
+
+def role_member_ids(*roles):
+    """Ids of the users with any of roles, cached until role membership changes"""
+    version = cache_version('role_members')
+    if version is None:
+        return sorted(db.session.execute(db.select(User.id).where(User.role.in_(roles))).scalars())
+    with _role_members_lock:
+        if _role_members['version'] != version:
+            _role_members['version'] = version
+            _role_members['roles'] = {}
+        cached = _role_members['roles']
+        missing = [role for role in roles if role not in cached]
+    
+    if missing:
+        members = {role: [] for role in missing}
+        for role, user_id in db.session.execute(
+            db.select(User.role, User.id).where(User.role.in_(missing)).order_by(User.id)
+        ):
+            members[role].append(user_id)
+        with _role_members_lock:
+            # A newer version may have been seen meanwhile; don't mix the two
+            if _role_members['version'] == version:
+                _role_members['roles'].update(members)
+        cached = dict(cached, **members)
+    return sorted(user_id for role in roles for user_id in cached[role])
+
+@db.event.listens_for(db.session, 'before_flush')
+def invalidate_role_members(session, flush_context, instances):
+    """Bump the role membership version along with any user insert, delete or role change"""
+    changed = any(isinstance(obj, User) for obj in list(session.new) + list(session.deleted)) or any(
+        isinstance(obj, User) and db.inspect(obj).attrs.role.history.has_changes()
+        for obj in session.dirty
+    )
+    if changed:
+        bump_cache_version('role_members')
+
+# Ticket statistics
+# Status x category counts for the dashboard panels, cached per visibility
+# scope for TICKET_STATS_TTL seconds and dropped as soon as a ticket write
+# bumps the ticket_stats version
+_ticket_stats = {}
+_ticket_stats_lock = threading.Lock()
+
+def ticket_stats_query(user):
+    """Ticket counts per (status, category_id) for the tickets user can see"""
+    query = db.select(Ticket.status, Ticket.category_id, db.func.count()).group_by(Ticket.status, Ticket.category_id)
+    if user.role == 'user':
+        query = query.where(Ticket.user_id == user.id)
+    return query
+
+def ticket_stats(user):
+    """Ticket counts visible to user
+
+    Returns {'status': {...}, 'category': {...}, 'groups': {(status,
+    category_id): n}, 'total': n}; see ticket_total() for filtered totals.
+    """
+    scope = user.id if user.role == 'user' else 'staff'
+    version = cache_version('ticket_stats')
+    now = time.monotonic()
+    with _ticket_stats_lock:
+        cached = _ticket_stats.get(scope)
+        if cached and cached[0] == version and cached[1] > now:
+            return cached[2]
+    
+    stats = {'status': {}, 'category': {}, 'groups': {}, 'total': 0}
+    for status, category_id, count in db.session.execute(ticket_stats_query(user)):
+        stats['groups'][status, category_id] = count
+        stats['status'][status] = stats['status'].get(status, 0) + count
+        stats['category'][category_id] = stats['category'].get(category_id, 0) + count
+        stats['total'] += count
+    
+    if version is not None:
+        with _ticket_stats_lock:
+            # Drop expired entries so per-customer scopes don't accumulate
+            for key in [key for key, entry in _ticket_stats.items() if entry[1] <= now]:
+                del _ticket_stats[key]
+            _ticket_stats[scope] = (version, now + app.config['TICKET_STATS_TTL'], stats)
+    return stats
+
+def ticket_total(stats, status=None, category_id=None):
+    """Number of tickets matching the dashboard's status and category filters
+
+    Summed from the cached ticket_stats() groups, so it is exact without a
+    COUNT over the filtered tickets.
+    """
+    return sum(
+        count for (group_status, group_category_id), count in stats['groups'].items()
+        if (not status or group_status == status) and (not category_id or str(group_category_id) == str(category_id))
+    )
+
+@db.event.listens_for(db.session, 'before_flush')
+def invalidate_ticket_stats(session, flush_context, instances):
+    """Bump the ticket_stats version along with any change to what the stats count"""
+    changed = any(isinstance(obj, Ticket) for obj in list(session.new) + list(session.deleted)) or any(
+        isinstance(obj, Ticket) and any(
+            getattr(db.inspect(obj).attrs, name).history.has_changes()
+            for name in ('status', 'category_id', 'user_id')
+        )
+        for obj in session.dirty
+    )
+    if changed:
+        bump_cache_version('ticket_stats')
+
+# Ticket page cache
+# Ticket ids, in order, of recently served dashboard pages, keyed by
+# visibility scope, filters, sort and cursor. An entry is only used while the
+# ticket_list version is unchanged, and any ticket or comment write bumps it,
+# so a refresh with nothing new reloads its rows by primary key instead of
+# filtering and sorting again.
+_ticket_pages = {}
+_ticket_pages_lock = threading.Lock()
+
+def ticket_page(user, status=None, category_id=None, search=None, sort=None, queue=None, cursor=None, per_page=10):
+    """A KeysetPage of ticket_list_query(), cached while no ticket changes"""
+    scope = user.id if user.role == 'user' or queue == 'mine' else 'staff'
+    key = (scope, status or '', str(category_id or ''), search or '', sort, queue or '', cursor, per_page)
+    version = cache_version('ticket_list')
+    now = time.monotonic()
+    with _ticket_pages_lock:
+        cached = _ticket_pages.get(key)
+    if cached and cached[0] == version and cached[1] > now:
+        _, _, ticket_ids, next_cursor, prev_cursor = cached
+        tickets = {
+            ticket.id: ticket
+            for ticket in with_ticket_list_options(Ticket.query.filter(Ticket.id.in_(ticket_ids)))
+        }
+        # A ticket deleted by another process before its version bump landed
+        if len(tickets) == len(ticket_ids):
+            return KeysetPage([tickets[ticket_id] for ticket_id in ticket_ids], next_cursor, prev_cursor)
+    
+    query, keys = ticket_list_query(user, status, category_id, search, sort, queue)
+    page = keyset_paginate(with_ticket_list_options(query), keys, cursor, per_page)
+    
+    if version is not None:
+        with _ticket_pages_lock:
+            for stale in [stale for stale, entry in _ticket_pages.items() if entry[0] != version or entry[1] <= now]:
+                del _ticket_pages[stale]
+            # Evict the oldest entries once the cache is full
+            while len(_ticket_pages) >= app.config['TICKET_PAGE_CACHE_SIZE']:
+                del _ticket_pages[next(iter(_ticket_pages))]
+            _ticket_pages[key] = (
+                version, now + app.config['TICKET_PAGE_CACHE_TTL'],
+                [ticket.id for ticket in page.items], page.next_cursor, page.prev_cursor
+            )
+    return page
+
+@db.event.listens_for(db.session, 'before_flush')
+def invalidate_ticket_pages(session, flush_context, instances):
+    """Bump the ticket_list version along with any change to a ticket or its comments
+
+    Ticket edits move it in the updated_at order, and comment text is
+    searchable, so every new, deleted or modified Ticket or Comment counts.
+    """
+    changed = any(isinstance(obj, (Ticket, Comment)) for obj in list(session.new) + list(session.deleted)) or any(
+        isinstance(obj, (Ticket, Comment)) and session.is_modified(obj)
+        for obj in session.dirty
+    )
+    if changed:
+        bump_cache_version('ticket_list')
+
+# Work queues
+# Agents work from their own active tickets and the open unassigned ones,
+# overall and per category. QueueCount holds each queue's size, adjusted in
+# the same flush as the ticket change, so the sidebar badges are one primary
+# key lookup rather than a count per queue.
+ACTIVE_STATUSES = ('open', 'in_progress')
+
+def ticket_queues(assigned_to, status, category_id):
+    """Names of the work queues a ticket with these values is in"""
+    if assigned_to is not None:
+        return [f'agent:{assigned_to}'] if status in ACTIVE_STATUSES else []
+    return ['unassigned', f'unassigned:{category_id}'] if status == 'open' else []
+
+def queue_counts(*queues):
+    """{queue: count} for the named work queues"""
+    counts = dict(db.session.execute(
+        db.select(QueueCount.queue, QueueCount.count).where(QueueCount.queue.in_(queues))
+    ).all())
+    return {queue: counts.get(queue, 0) for queue in queues}
+
+def rebuild_queue_counts():
+    """Recount every work queue from the tickets; the caller commits"""
+    assigned = db.session.execute(
+        db.select(Ticket.assigned_to, db.func.count())
+        .where(Ticket.assigned_to.isnot(None), Ticket.status.in_(ACTIVE_STATUSES))
+        .group_by(Ticket.assigned_to)
+    ).all()
+    unassigned = db.session.execute(
+        db.select(Ticket.category_id, db.func.count())
+        .where(Ticket.assigned_to.is_(None), Ticket.status == 'open')
+        .group_by(Ticket.category_id)
+    ).all()
+    rows = [{'queue': f'agent:{user_id}', 'count': count} for user_id, count in assigned]
+    rows += [{'queue': f'unassigned:{category_id}', 'count': count} for category_id, count in unassigned]
+    rows.append({'queue': 'unassigned', 'count': sum(count for _, count in unassigned)})
+    db.session.execute(db.delete(QueueCount))
+    db.session.execute(db.insert(QueueCount), rows)
+
+@db.event.listens_for(db.session, 'before_flush')
+def maintain_queue_counts(session, flush_context, instances):
+    """Move tickets between work queue counts as they are created, reassigned, closed or deleted"""
+    deltas = {}
+    
+    def move(queues, delta):
+        for queue in queues:
+            deltas[queue] = deltas.get(queue, 0) + delta
+    
+    def values(obj, old):
+        state = db.inspect(obj)
+        if old:
+            # Values as last flushed, whatever has been assigned since
+            result = []
+            for name in ('assigned_to', 'status', 'category_id'):
+                history = getattr(state.attrs, name).load_history()
+                result.append((history.deleted or history.unchanged or [getattr(obj, name)])[0])
+            return result
+        return [obj.assigned_to, obj.status if obj.status is not None else 'open', obj.category_id]
+    
+    for obj in session.new:
+        if isinstance(obj, Ticket):
+            move(ticket_queues(*values(obj, old=False)), 1)
+    for obj in session.deleted:
+        if isinstance(obj, Ticket):
+            move(ticket_queues(*values(obj, old=True)), -1)
+    for obj in session.dirty:
+        if isinstance(obj, Ticket) and session.is_modified(obj):
+            move(ticket_queues(*values(obj, old=True)), -1)
+            move(ticket_queues(*values(obj, old=False)), 1)
+    
+    changes = [{'b_queue': queue, 'b_delta': delta} for queue, delta in deltas.items() if delta]
+    if changes:
+        insert_ignore(QueueCount, [{'queue': change['b_queue']} for change in changes], session)
+        session.execute(
+            db.update(QueueCount.__table__)
+            .where(QueueCount.queue == db.bindparam('b_queue'))
+            .values(count=QueueCount.count + db.bindparam('b_delta')),
+            changes
+        )
+
 # Notification helper functions
-def create_notification(user_id, ticket_id, notification_type, message, comment_id=None):
+# Rows handed to the driver per executemany() batch
+NOTIFICATION_INSERT_BATCH = 500
+
+# Types folded into the recipient's existing unread notification for the ticket
+COALESCED_NOTIFICATION_TYPES = {'comment_added'}
+
+# Role-wide events are stored once per audience and merged into inboxes on read
+BROADCAST_AUDIENCES = {
+    'staff': ('admin', 'agent'),
+    'admins': ('admin',),
+}
+
+def broadcast_audiences(role):
+    """Audiences whose broadcasts a user with role receives"""
+    return [audience for audience, roles in BROADCAST_AUDIENCES.items() if role in roles]
+
+# Notifications store a type, the actor and a few parameters; their text is
+# rendered from these templates when displayed, so it always shows the
+# ticket's current subject. A "reason" parameter selects a variant.
+NOTIFICATION_MESSAGES = {
+    'ticket_created': 'New ticket "{subject}" created by {actor}',
+    'ticket_assigned': 'Ticket "{subject}" has been assigned to you',
+    'status_changed': 'Your ticket "{subject}" status changed from {old_status} to {new_status}',
+    'comment_added': 'New comment on your ticket "{subject}" by {actor}',
+    'comment_added:assignee': 'New comment on assigned ticket "{subject}" by {actor}',
+    'comment_added:priority': 'New comment on {priority} priority ticket "{subject}" by {actor}',
+}
+
+def render_notification_message(notification_type, ticket, actor, params):
+    """Text of a notification from its type, ticket, actor and parameters"""
+    params = dict(params or {})
+    reason = params.pop('reason', None)
+    template = NOTIFICATION_MESSAGES.get(f'{notification_type}:{reason}' if reason else notification_type)
+    if template is None:
+        return notification_type.replace('_', ' ').capitalize()
+    for key in ('old_status', 'new_status'):
+        if key in params:
+            params[key] = params[key].replace('_', ' ').title()
+    return template.format(
+        subject=ticket.subject if ticket else 'a deleted ticket',
+        priority=ticket.priority if ticket else '',
+        actor=actor.username if actor else 'a former user',
+        **params
+    )
+
+def _row_message(row):
+    return render_notification_message(
+        row['type'],
+        db.session.get(Ticket, row['ticket_id']),
+        db.session.get(User, row['actor_id']) if row['actor_id'] else None,
+        json.loads(row['params']) if row['params'] else None
+    )
+
+def create_broadcast(audience, ticket_id, notification_type, actor_id=None, **params):
+    """Store one notification for every user in an audience; the caller commits"""
+    row = {
+        'audience': audience,
+        'ticket_id': ticket_id,
+        'type': notification_type,
+        'actor_id': actor_id,
+        'params': json.dumps(params) if params else None,
+    }
+    db.session.add(BroadcastNotification(**row))
+    message = _row_message(row)
+    queue_broadcast_event(BROADCAST_AUDIENCES[audience], {
+        'ticket_id': ticket_id,
+        'type': notification_type,
+        'message': message,
+    })
+    if app.config['MAIL_ENABLED']:
+        queue_broadcast_emails(audience, ticket_id, message)
+
+def notification_row(user_id, ticket_id, notification_type, actor_id=None, comment_id=None, **params):
+    """Build a notification row for create_notifications; params are kept for rendering"""
+    return {
+        'user_id': user_id,
+        'ticket_id': ticket_id,
+        'type': notification_type,
+        'actor_id': actor_id,
+        'comment_id': comment_id,
+        'params': json.dumps(params) if params else None,
+    }
+
+def _fold_notification(row, now, notification_id=None):
+    """Add row's events to the unread notification it coalesces with; False if there is none
+
+    notification_id names the row found by a lookup; it only takes the
+    events if it is still unread.
+    """
+    if notification_id is None:
+        target = db.and_(
+            Notification.user_id == row['user_id'],
+            Notification.ticket_id == row['ticket_id'],
+            Notification.type == row['type'],
+        )
+    else:
+        target = Notification.id == notification_id
+    result = db.session.execute(
+        db.update(Notification)
+        .where(target, Notification.is_read == False)
+        .values(
+            event_count=Notification.event_count + row['event_count'],
+            actor_id=row['actor_id'],
+            params=row['params'],
+            comment_id=row['comment_id'],
+            # Text stored by older versions would hide the new actor and count
+            stored_message='',
+            created_at=now
+        )
+    )
+    return result.rowcount > 0
+
+def coalesce_notifications(rows, now):
+    """Fold rows into matching unread notifications
+
+    While a user still has an unread notification of a coalesced type for a
+    ticket, a new one bumps that row's event_count and latest actor instead
+    of adding another row. Returns the rows still to insert, as (plain,
+    coalesced): coalesced rows go in through insert_coalesced_notifications().
+    """
+    plain, pending = [], {}
+    for row in rows:
+        if row['type'] not in COALESCED_NOTIFICATION_TYPES:
+            plain.append(row)
+            continue
+        key = (row['user_id'], row['ticket_id'], row['type'])
+        if key in pending:
+            pending[key]['event_count'] += 1
+        else:
+            pending[key] = row
+    
+    lookups = {}
+    for user_id, ticket_id, notification_type in pending:
+        lookups.setdefault((ticket_id, notification_type), []).append(user_id)
+    
+    for (ticket_id, notification_type), user_ids in lookups.items():
+        existing = db.session.execute(
+            db.select(Notification.id, Notification.user_id).where(
+                Notification.ticket_id == ticket_id,
+                Notification.type == notification_type,
+                Notification.is_read == False,
+                Notification.user_id.in_(user_ids)
+            )
+        ).all()
+        for notification_id, user_id in existing:
+            key = (user_id, ticket_id, notification_type)
+            # A row marked read since the lookup takes no more events, so a new one is inserted
+            if key in pending and _fold_notification(pending[key], now, notification_id):
+                del pending[key]
+    return plain, list(pending.values())
+
+def insert_coalesced_notifications(rows, now):
+    """Insert new coalesced notifications; returns the rows actually inserted
+
+    ux_notification_unread_coalesce allows one unread row per user, ticket
+    and coalesced type. If another writer has added one since the lookup,
+    the insert conflicts and the events are folded into that row instead.
+    """
+    if not rows:
+        return []
+    try:
+        with db.session.begin_nested():
+            db.session.execute(db.insert(Notification), rows)
+        return rows
+    except IntegrityError:
+        pass
+    
+    inserted = []
+    for row in rows:
+        try:
+            with db.session.begin_nested():
+                db.session.execute(db.insert(Notification), [row])
+        except IntegrityError:
+            if not _fold_notification(row, now):
+                raise
+            continue
+        inserted.append(row)
+    return inserted
+
+def merge_coalesced_duplicates():
+    """Fold duplicate unread coalesced notifications into the newest of each; the caller commits
+
+    Returns the number of rows removed. Writers that raced past the lookup
+    could leave such duplicates before ux_notification_unread_coalesce
+    existed, and they would keep the index from being created.
+    """
+    duplicates = db.session.execute(
+        db.select(
+            Notification.user_id, Notification.ticket_id, Notification.type,
+            db.func.max(Notification.id), db.func.sum(Notification.event_count), db.func.count()
+        )
+        .where(Notification.is_read == False, Notification.type.in_(COALESCED_NOTIFICATION_TYPES))
+        .group_by(Notification.user_id, Notification.ticket_id, Notification.type)
+        .having(db.func.count() > 1)
+    ).all()
+    deltas = {}
+    for user_id, ticket_id, notification_type, keep_id, events, count in duplicates:
+        db.session.execute(
+            db.update(Notification).where(Notification.id == keep_id).values(event_count=events)
+        )
+        db.session.execute(
+            db.delete(Notification).where(
+                Notification.user_id == user_id,
+                Notification.ticket_id == ticket_id,
+                Notification.type == notification_type,
+                Notification.is_read == False,
+                Notification.id != keep_id,
+            )
+        )
+        deltas[user_id] = deltas.get(user_id, 0) - (count - 1)
+    ensure_notification_states(deltas)
+    adjust_unread_counts(deltas)
+    return -sum(deltas.values())
+
+def create_notifications(rows):
+    """Insert many notifications with batched INSERTs; the caller commits"""
+    now = datetime.utcnow()
+    rows = [dict(row, is_read=False, created_at=now, event_count=1) for row in rows]
+    ensure_notification_states(row['user_id'] for row in rows)
+    messages = [_row_message(row) for row in rows]
+    if app.config['MAIL_ENABLED']:
+        queue_notification_emails(rows, messages)
+    events = [(row['user_id'], {
+        'ticket_id': row['ticket_id'],
+        'type': row['type'],
+        'message': message,
+    }) for row, message in zip(rows, messages)]
+    
+    rows, coalesced = coalesce_notifications(rows, now)
+    for start in range(0, len(rows), NOTIFICATION_INSERT_BATCH):
+        db.session.execute(db.insert(Notification), rows[start:start + NOTIFICATION_INSERT_BATCH])
+    rows += insert_coalesced_notifications(coalesced, now)
+    
+    # Coalesced notifications were already unread, so only new rows count
+    deltas = {}
+    for row in rows:
+        deltas[row['user_id']] = deltas.get(row['user_id'], 0) + 1
+    adjust_unread_counts(deltas)
+    
+    for user_id, event in events:
+        queue_notification_event(user_id, event)
+    return len(rows)
+
+def create_notification(user_id, ticket_id, notification_type, actor_id=None, comment_id=None, **params):
     """Create a notification for a user"""
-    notification = Notification(
-        user_id=user_id,
-        ticket_id=ticket_id,
-        type=notification_type,
-        message=message,
-        comment_id=comment_id
+    create_notifications([notification_row(user_id, ticket_id, notification_type, actor_id, comment_id, **params)])
+
+def insert_ignore(model, rows, session=None):
+    """Insert rows into model, skipping those whose primary key already exists"""
+    session = session or db.session
+    dialect = session.get_bind().dialect.name
+    if dialect == 'sqlite':
+        session.execute(sqlite.insert(model).on_conflict_do_nothing(), rows)
+    elif dialect == 'postgresql':
+        session.execute(postgresql.insert(model).on_conflict_do_nothing(), rows)
+    elif dialect == 'mysql':
+        session.execute(mysql.insert(model).prefix_with('IGNORE'), rows)
+    else:
+        # Insert the missing keys one at a time, each in a savepoint so a
+        # concurrent insert of the same key only rolls back that row
+        key = model.__table__.primary_key.columns[0]
+        existing = set(session.execute(
+            db.select(key).where(key.in_([row[key.name] for row in rows]))
+        ).scalars())
+        for row in rows:
+            if row[key.name] in existing:
+                continue
+            try:
+                with session.begin_nested():
+                    session.execute(db.insert(model), [row])
+            except IntegrityError:
+                pass
+
+def broadcast_watermarks(user_ids):
+    """{user_id: newest broadcast created before the user joined}, for users with one"""
+    return dict(db.session.execute(
+        db.select(User.id, db.func.max(BroadcastNotification.id))
+        .join(BroadcastNotification, BroadcastNotification.created_at < User.created_at)
+        .where(User.id.in_(user_ids))
+        .group_by(User.id)
+    ).all())
+
+def ensure_notification_states(user_ids):
+    """Create missing counter rows, seeded from the users' unread notifications"""
+    user_ids = set(user_ids)
+    if not user_ids:
+        return
+    
+    existing = db.session.execute(
+        db.select(NotificationState.user_id).where(NotificationState.user_id.in_(user_ids))
+    ).scalars()
+    missing = user_ids.difference(existing)
+    if missing:
+        unread = dict(db.session.execute(
+            db.select(Notification.user_id, db.func.count())
+            .where(Notification.user_id.in_(missing), Notification.is_read == False)
+            .group_by(Notification.user_id)
+        ).all())
+        # Broadcasts from before the user joined start out read
+        watermarks = broadcast_watermarks(missing)
+        insert_ignore(NotificationState, [{
+            'user_id': user_id,
+            'unread_count': unread.get(user_id, 0),
+            'broadcast_read_id': watermarks.get(user_id, 0),
+        } for user_id in missing])
+
+def adjust_unread_counts(deltas):
+    """Add deltas ({user_id: n}) to users' unread counters in the current transaction
+
+    Callers run ensure_notification_states() before changing notifications.
+    """
+    # Group users by delta so a typical fan-out (+1 each) is a single UPDATE
+    by_delta = {}
+    for user_id, delta in deltas.items():
+        if delta:
+            by_delta.setdefault(delta, []).append(user_id)
+    for delta, user_ids in by_delta.items():
+        db.session.execute(
+            db.update(NotificationState)
+            .where(NotificationState.user_id.in_(user_ids))
+            .values(unread_count=NotificationState.unread_count + delta, version=NotificationState.version + 1)
+        )
+
+def notification_state(user):
+    """Return user's NotificationState, creating it on first use"""
+    state = db.session.get(NotificationState, user.id)
+    if state is None:
+        ensure_notification_states([user.id])
+        db.session.commit()
+        state = db.session.get(NotificationState, user.id)
+    return state
+
+def unread_notification_count(user):
+    """Return a user's unread notifications, direct and broadcast
+
+    Direct notifications are a counter lookup; unread broadcasts are an index
+    range count past the user's read watermark.
+    """
+    state = notification_state(user)
+    audiences = broadcast_audiences(user.role)
+    broadcasts = 0
+    if audiences:
+        broadcasts = db.session.execute(
+            db.select(db.func.count()).select_from(BroadcastNotification).where(
+                BroadcastNotification.audience.in_(audiences),
+                BroadcastNotification.id > state.broadcast_read_id
+            )
+        ).scalar()
+    return state.unread_count + broadcasts
+
+def notification_count_etag(user):
+    """ETag for a user's unread count, built without touching the notification table
+
+    The count only changes when the user's counter version moves or a
+    broadcast for their audiences is added or archived. Archiving removes the
+    oldest broadcasts, so the tag holds the oldest and newest broadcast ids.
+    """
+    state = notification_state(user)
+    oldest, newest = broadcast_id_range(user)
+    return f'{user.id}.{state.version}.{oldest}.{newest}'
+
+def _seek_before(model, kind_rank, position):
+    """Filter for model rows that sort after position in (created_at, kind, id) DESC order"""
+    created_at, position_rank, position_id = position
+    if kind_rank < position_rank:
+        return model.created_at <= created_at
+    if kind_rank > position_rank:
+        return model.created_at < created_at
+    return db.tuple_(model.created_at, model.id) < (created_at, position_id)
+
+def notification_position(notification):
+    """Token for notification's place in the inbox, as fetch_notifications cursors encode it"""
+    return encode_cursor(notification.created_at, notification.kind_rank, notification.id)
+
+def fetch_notifications(user, cursor=None, limit=20):
+    """Return a page of a user's notifications, newest first, and the next cursor
+
+    Direct notifications and the broadcasts for the user's role are each read
+    with an index seek past the previous page's (created_at, kind, id), then
+    merged, so deep pages cost the same as the first one.
+    """
+    position = decode_cursor(cursor, datetime, int, int)
+    
+    query = Notification.query.filter(Notification.user_id == user.id)
+    if position:
+        query = query.filter(_seek_before(Notification, Notification.kind_rank, position))
+    items = query.options(db.joinedload(Notification.ticket), db.joinedload(Notification.actor)).order_by(
+        Notification.created_at.desc(), Notification.id.desc()
+    ).limit(limit + 1).all()
+    
+    audiences = broadcast_audiences(user.role)
+    if audiences:
+        read_id = notification_state(user).broadcast_read_id
+        for audience in audiences:
+            query = BroadcastNotification.query.filter(
+                BroadcastNotification.audience == audience,
+                BroadcastNotification.created_at >= user.created_at
+            )
+            if position:
+                query = query.filter(_seek_before(BroadcastNotification, BroadcastNotification.kind_rank, position))
+            broadcasts = query.options(db.joinedload(BroadcastNotification.ticket), db.joinedload(BroadcastNotification.actor)).order_by(
+                BroadcastNotification.created_at.desc(), BroadcastNotification.id.desc()
+            ).limit(limit + 1).all()
+            for broadcast in broadcasts:
+                broadcast.is_read = broadcast.id <= read_id
+            items.extend(broadcasts)
+        items.sort(key=lambda item: (item.created_at, item.kind_rank, item.id), reverse=True)
+    
+    next_cursor = None
+    if len(items) > limit:
+        items = items[:limit]
+        last = items[-1]
+        next_cursor = notification_position(last)
+    return items, next_cursor
+
+def mark_notifications_read(user_id, *criteria):
+    """Mark user's unread notifications matching criteria as read; the caller commits
+
+    A single UPDATE scoped to the user, so ids belonging to someone else are
+    simply not matched. Returns the number of notifications marked.
+    """
+    ensure_notification_states([user_id])
+    result = db.session.execute(
+        db.update(Notification)
+        .where(Notification.user_id == user_id, Notification.is_read == False, *criteria)
+        .values(is_read=True)
     )
-    db.session.add(notification)
-    db.session.commit()
+    if result.rowcount:
+        adjust_unread_counts({user_id: -result.rowcount})
+        queue_notification_event(user_id)
+    return result.rowcount
 
-def notify_ticket_created(ticket):
-    """Notify admins and agents about new ticket"""
-    # Notify all admins
-    admins = User.query.filter_by(role='admin').all()
-    for admin in admins:
-        create_notification(
-            admin.id,
-            ticket.id,
-            'ticket_created',
-            f'New ticket "{ticket.subject}" created by {ticket.author.username}'
+def broadcast_id_range(user):
+    """Ids of the oldest and newest broadcasts user receives, (0, 0) if there are none"""
+    audiences = broadcast_audiences(user.role)
+    if not audiences:
+        return 0, 0
+    oldest, newest = db.session.execute(
+        db.select(db.func.min(BroadcastNotification.id), db.func.max(BroadcastNotification.id))
+        .where(BroadcastNotification.audience.in_(audiences))
+    ).one()
+    return oldest or 0, newest or 0
+
+def latest_broadcast_id(user):
+    """Id of the newest broadcast user receives, or 0 if there is none"""
+    return broadcast_id_range(user)[1]
+
+def mark_broadcasts_read(user, up_to_id):
+    """Advance user's broadcast read watermark to up_to_id; the caller commits"""
+    notification_state(user)
+    db.session.execute(
+        db.update(NotificationState)
+        .where(NotificationState.user_id == user.id, NotificationState.broadcast_read_id < up_to_id)
+        .values(broadcast_read_id=up_to_id, version=NotificationState.version + 1)
+    )
+
+def _archive_rows(notifications, broadcast=False):
+    now = datetime.utcnow()
+    return [{
+        'original_id': notification.id,
+        'user_id': None if broadcast else notification.user_id,
+        'audience': notification.audience if broadcast else None,
+        'ticket_id': notification.ticket_id,
+        'comment_id': None if broadcast else notification.comment_id,
+        'type': notification.type,
+        'message': notification.message,
+        'is_read': None if broadcast else notification.is_read,
+        'event_count': notification.event_count,
+        'created_at': notification.created_at,
+        'archived_at': now,
+    } for notification in notifications]
+
+def prune_notifications(retention_days=None, archive_days=None, batch_size=None, pause=None):
+    """Apply the notification retention policy in small batches
+
+    Notifications older than archive_days are moved to notification_archive
+    and read notifications older than retention_days are deleted. Each batch
+    is its own short transaction, with a pause in between so request writers
+    are never locked out for long. Returns counts and the elapsed time.
+    """
+    retention_days = app.config['NOTIFICATION_RETENTION_DAYS'] if retention_days is None else retention_days
+    archive_days = app.config['NOTIFICATION_ARCHIVE_DAYS'] if archive_days is None else archive_days
+    batch_size = batch_size or app.config['NOTIFICATION_PRUNE_BATCH']
+    pause = app.config['NOTIFICATION_PRUNE_PAUSE'] if pause is None else pause
+    
+    started = time.perf_counter()
+    now = datetime.utcnow()
+    stats = {'archived': 0, 'broadcasts_archived': 0, 'deleted': 0}
+    
+    def batches(select_batch, process):
+        while True:
+            batch = select_batch()
+            if not batch:
+                return
+            process(batch)
+            db.session.commit()
+            if len(batch) < batch_size:
+                return
+            time.sleep(pause)
+    
+    if archive_days:
+        cutoff = now - timedelta(days=archive_days)
+        
+        def archive_direct(notifications):
+            db.session.execute(db.insert(NotificationArchive), _archive_rows(notifications))
+            unread = {}
+            for notification in notifications:
+                if not notification.is_read:
+                    unread[notification.user_id] = unread.get(notification.user_id, 0) - 1
+            ensure_notification_states(unread)
+            adjust_unread_counts(unread)
+            db.session.execute(
+                db.delete(Notification).where(Notification.id.in_([n.id for n in notifications]))
+            )
+            stats['archived'] += len(notifications)
+        
+        def archive_broadcasts(broadcasts):
+            db.session.execute(db.insert(NotificationArchive), _archive_rows(broadcasts, broadcast=True))
+            db.session.execute(
+                db.delete(BroadcastNotification).where(BroadcastNotification.id.in_([b.id for b in broadcasts]))
+            )
+            stats['broadcasts_archived'] += len(broadcasts)
+        
+        batches(
+            lambda: Notification.query.filter(Notification.created_at < cutoff)
+            .options(db.joinedload(Notification.ticket), db.joinedload(Notification.actor))
+            .order_by(Notification.created_at).limit(batch_size).all(),
+            archive_direct
+        )
+        batches(
+            lambda: BroadcastNotification.query.filter(BroadcastNotification.created_at < cutoff)
+            .options(db.joinedload(BroadcastNotification.ticket), db.joinedload(BroadcastNotification.actor))
+            .order_by(BroadcastNotification.created_at).limit(batch_size).all(),
+            archive_broadcasts
         )
     
-    # Notify all agents
-    agents = User.query.filter_by(role='agent').all()
-    for agent in agents:
-        create_notification(
-            agent.id,
-            ticket.id,
-            'ticket_created',
-            f'New ticket "{ticket.subject}" created by {ticket.author.username}'
+    if retention_days:
+        cutoff = now - timedelta(days=retention_days)
+        
+        def delete_read(notification_ids):
+            db.session.execute(db.delete(Notification).where(Notification.id.in_(notification_ids)))
+            stats['deleted'] += len(notification_ids)
+        
+        batches(
+            lambda: db.session.execute(
+                db.select(Notification.id)
+                .where(Notification.created_at < cutoff, Notification.is_read == True)
+                .order_by(Notification.created_at).limit(batch_size)
+            ).scalars().all(),
+            delete_read
         )
+    
+    stats['seconds'] = time.perf_counter() - started
+    return stats
+
+def repair_unread_counts(batch_size=500):
+    """Recompute every user's unread counter in batches; returns (users, fixed)"""
+    users = fixed = 0
+    last_id = 0
+    while True:
+        user_ids = db.session.execute(
+            db.select(User.id).where(User.id > last_id).order_by(User.id).limit(batch_size)
+        ).scalars().all()
+        if not user_ids:
+            break
+        last_id = user_ids[-1]
+        
+        # Start with a write so SQLite takes its write lock before counting; other
+        # databases lock the counter rows with FOR UPDATE. Either way no
+        # concurrent increment can land between the count and the update.
+        # Missing rows start with broadcasts from before the user joined read.
+        watermarks = broadcast_watermarks(user_ids)
+        insert_ignore(NotificationState, [
+            {'user_id': user_id, 'broadcast_read_id': watermarks.get(user_id, 0)} for user_id in user_ids
+        ])
+        current = dict(db.session.execute(
+            db.select(NotificationState.user_id, NotificationState.unread_count)
+            .where(NotificationState.user_id.in_(user_ids))
+            .with_for_update()
+        ).all())
+        actual = dict(db.session.execute(
+            db.select(Notification.user_id, db.func.count())
+            .where(Notification.user_id.in_(user_ids), Notification.is_read == False)
+            .group_by(Notification.user_id)
+        ).all())
+        
+        updates = [
+            {'b_user_id': user_id, 'b_unread_count': actual.get(user_id, 0)}
+            for user_id in user_ids if current.get(user_id) != actual.get(user_id, 0)
+        ]
+        if updates:
+            db.session.execute(
+                db.update(NotificationState.__table__)
+                .where(NotificationState.user_id == db.bindparam('b_user_id'))
+                .values(unread_count=db.bindparam('b_unread_count'), version=NotificationState.version + 1),
+                updates
+            )
+        db.session.commit()
+        users += len(user_ids)
+        fixed += len(updates)
+    return users, fixed
+
+# Email delivery
+# Notification emails are stored in outgoing_email and sent by send_emails
+# jobs, so SMTP latency never reaches a request. Jobs share pooled
+# connections per server, send many messages over each one and are rate
+# limited per server.
+
+# Recipients per message when one email goes to a whole audience
+EMAIL_RECIPIENTS_PER_MESSAGE = 50
+
+# Idle connections older than this are checked with NOOP before reuse
+SMTP_IDLE_CHECK_SECONDS = 10
+
+class RateLimiter:
+    """Token bucket allowing rate events per second, in bursts of up to one second's worth"""
+    
+    def __init__(self, rate):
+        self.rate = rate
+        self.capacity = max(rate, 1)
+        self._tokens = self.capacity
+        self._updated = time.monotonic()
+        self._lock = threading.Lock()
+    
+    def acquire(self):
+        """Block until an event is allowed"""
+        if not self.rate:
+            return
+        with self._lock:
+            now = time.monotonic()
+            self._tokens = min(self.capacity, self._tokens + (now - self._updated) * self.rate)
+            self._updated = now
+            # Reserve the token now and sleep off any debt outside the lock
+            self._tokens -= 1
+            wait = -self._tokens / self.rate if self._tokens < 0 else 0
+        if wait:
+            time.sleep(wait)
+
+class PooledSMTPConnection:
+    """An open SMTP session borrowed from an SMTPConnectionPool"""
+    
+    def __init__(self, pool):
+        self.pool = pool
+        self.smtp = pool._open()
+        self.sent = 0
+        self.last_used = time.monotonic()
+    
+    def send(self, message, recipients):
+        """Send message to recipients; returns the recipients the server refused
+
+        The session is replaced once it has carried the pool's
+        messages_per_connection messages.
+        """
+        if self.sent >= self.pool.messages_per_connection:
+            self.close()
+            self.smtp = self.pool._open()
+            self.sent = 0
+        self.pool.rate_limiter.acquire()
+        self.sent += 1
+        self.last_used = time.monotonic()
+        return self.smtp.send_message(message, to_addrs=recipients)
+    
+    def close(self):
+        try:
+            self.smtp.quit()
+        except (smtplib.SMTPException, OSError):
+            self.smtp.close()
+
+class SMTPConnectionPool:
+    """Reusable connections to one SMTP server, sharing one rate limit"""
+    
+    def __init__(self, host, port, use_tls=False, username=None, password=None,
+                 size=2, messages_per_connection=100, rate_limit=0, timeout=30):
+        self.host = host
+        self.port = port
+        self.use_tls = use_tls
+        self.username = username
+        self.password = password
+        self.messages_per_connection = messages_per_connection
+        self.timeout = timeout
+        self.rate_limiter = RateLimiter(rate_limit)
+        self.connections_opened = 0
+        self._slots = threading.BoundedSemaphore(size)
+        self._idle = []
+        self._lock = threading.Lock()
+    
+    def _open(self):
+        smtp = smtplib.SMTP(self.host, self.port, timeout=self.timeout)
+        try:
+            if self.use_tls:
+                smtp.starttls()
+            if self.username:
+                smtp.login(self.username, self.password)
+        except BaseException:
+            smtp.close()
+            raise
+        with self._lock:
+            self.connections_opened += 1
+        return smtp
+    
+    def _checkout(self):
+        with self._lock:
+            connection = self._idle.pop() if self._idle else None
+        if connection is None:
+            return PooledSMTPConnection(self)
+        
+        # Servers drop idle sessions, so make sure an old one is still alive
+        if time.monotonic() - connection.last_used > SMTP_IDLE_CHECK_SECONDS:
+            try:
+                if connection.smtp.noop()[0] != 250:
+                    raise smtplib.SMTPServerDisconnected('NOOP failed')
+            except (smtplib.SMTPException, OSError):
+                connection.close()
+                return PooledSMTPConnection(self)
+        return connection
+    
+    @contextmanager
+    def connection(self):
+        """Borrow a connection, blocking while all of them are in use
+
+        A connection is discarded if an exception escapes the block or it has
+        sent messages_per_connection messages; otherwise it goes back to the pool.
+        """
+        with self._slots:
+            connection = self._checkout()
+            try:
+                yield connection
+            except BaseException:
+                connection.close()
+                raise
+            if connection.sent >= self.messages_per_connection:
+                connection.close()
+            else:
+                with self._lock:
+                    self._idle.append(connection)
+    
+    def close(self):
+        """Close every idle connection"""
+        with self._lock:
+            idle, self._idle = self._idle, []
+        for connection in idle:
+            connection.close()
+
+_mail_pools = {}
+_mail_pools_lock = threading.Lock()
+
+def mail_pool():
+    """The connection pool for the configured mail server"""
+    key = (app.config['MAIL_SERVER'], app.config['MAIL_PORT'], app.config['MAIL_USE_TLS'], app.config['MAIL_USERNAME'])
+    with _mail_pools_lock:
+        if key not in _mail_pools:
+            _mail_pools[key] = SMTPConnectionPool(
+                app.config['MAIL_SERVER'],
+                app.config['MAIL_PORT'],
+                use_tls=app.config['MAIL_USE_TLS'],
+                username=app.config['MAIL_USERNAME'],
+                password=app.config['MAIL_PASSWORD'],
+                size=app.config['MAIL_POOL_SIZE'],
+                messages_per_connection=app.config['MAIL_MESSAGES_PER_CONNECTION'],
+                rate_limit=app.config['MAIL_RATE_LIMIT'],
+                timeout=app.config['MAIL_TIMEOUT']
+            )
+        return _mail_pools[key]
+
+def close_mail_pools():
+    """Close every pooled SMTP connection"""
+    with _mail_pools_lock:
+        pools = list(_mail_pools.values())
+        _mail_pools.clear()
+    for pool in pools:
+        pool.close()
+
+atexit.register(close_mail_pools)
+
+def queue_emails(messages):
+    """Store emails and queue jobs to send them in batches; the caller commits
+
+    messages are dicts with recipients (a list of addresses), subject and body.
+    """
+    now = datetime.utcnow()
+    rows = [{
+        'recipients': ','.join(message['recipients']),
+        'subject': message['subject'][:200],
+        'body': message['body'],
+        'status': 'queued',
+        'created_at': now,
+    } for message in messages if message['recipients']]
+    if not rows:
+        return 0
+    
+    email_ids = db.session.execute(db.insert(OutgoingEmail).returning(OutgoingEmail.id), rows).scalars().all()
+    batch_size = app.config['MAIL_BATCH_SIZE']
+    for start in range(0, len(email_ids), batch_size):
+        add_job('send_emails', email_ids=email_ids[start:start + batch_size])
+    return len(rows)
+
+def notification_email(recipients, ticket_id, message):
+    return {
+        'recipients': recipients,
+        'subject': f'[QuickDesk #{ticket_id}] {message}',
+        'body': f'{message}\n\nSign in to QuickDesk to view ticket #{ticket_id}.',
+    }
+
+def queue_notification_emails(rows, messages):
+    """Email the recipient of each notification row its message; the caller commits"""
+    user_ids = {row['user_id'] for row in rows}
+    emails = dict(db.session.execute(
+        db.select(User.id, User.email).where(User.id.in_(user_ids))
+    ).all())
+    return queue_emails(
+        notification_email([emails[row['user_id']]], row['ticket_id'], message)
+        for row, message in zip(rows, messages) if row['user_id'] in emails
+    )
+
+def queue_broadcast_emails(audience, ticket_id, message):
+    """Email everyone in audience, many recipients per message; the caller commits"""
+    emails = db.session.execute(
+        db.select(User.email).where(User.role.in_(BROADCAST_AUDIENCES[audience])).order_by(User.id)
+    ).scalars().all()
+    return queue_emails(
+        notification_email(emails[start:start + EMAIL_RECIPIENTS_PER_MESSAGE], ticket_id, message)
+        for start in range(0, len(emails), EMAIL_RECIPIENTS_PER_MESSAGE)
+    )
+
+def build_email(email):
+    """Build the MIME message for an OutgoingEmail"""
+    recipients = email.recipients.split(',')
+    message = EmailMessage()
+    message['From'] = app.config['MAIL_DEFAULT_SENDER']
+    # Audience emails list nobody in To, so recipients cannot see each other
+    message['To'] = recipients[0] if len(recipients) == 1 else 'undisclosed-recipients:;'
+    # Subjects come from ticket subjects, and a line break would end the header
+    message['Subject'] = ' '.join(email.subject.splitlines())
+    message.set_content(email.body)
+    return message
+
+def _is_permanent_smtp_error(error):
+    if isinstance(error, smtplib.SMTPRecipientsRefused):
+        return all(code >= 500 for code, _ in error.recipients.values())
+    return isinstance(error, smtplib.SMTPResponseException) and error.smtp_code >= 500
+
+@job_handler('send_emails')
+def send_emails(email_ids):
+    """Send queued emails over one pooled connection, recording each outcome
+
+    Messages that can't be built or are permanently rejected are marked
+    failed. Any other error commits the progress so far before it is raised,
+    so the retried job only sends what is left.
+    """
+    emails = OutgoingEmail.query.filter(
+        OutgoingEmail.id.in_(email_ids), OutgoingEmail.status == 'queued'
+    ).order_by(OutgoingEmail.id).all()
+    if not emails:
+        return
+    
+    try:
+        with mail_pool().connection() as connection:
+            for email in emails:
+                try:
+                    message = build_email(email)
+                except ValueError as error:
+                    email.status = 'failed'
+                    email.last_error = repr(error)
+                    continue
+                try:
+                    refused = connection.send(message, email.recipients.split(','))
+                except smtplib.SMTPException as error:
+                    if not _is_permanent_smtp_error(error):
+                        raise
+                    email.status = 'failed'
+                    email.last_error = repr(error)
+                    continue
+                email.status = 'sent'
+                email.sent_at = datetime.utcnow()
+                email.last_error = f'Refused: {refused!r}' if refused else None
+    except Exception:
+        db.session.commit()
+        raise
+
+def notify_ticket_created(ticket):
+    """Queue notifications to admins and agents about new ticket"""
+    enqueue_job('notify_ticket_created', ticket_id=ticket.id)
 
 def notify_ticket_assigned(ticket, assigned_user):
-    """Notify user when ticket is assigned to them"""
+    """Queue a notification to the user a ticket is assigned to"""
     if assigned_user:
-        create_notification(
-            assigned_user.id,
-            ticket.id,
-            'ticket_assigned',
-            f'Ticket "{ticket.subject}" has been assigned to you'
-        )
+        enqueue_job('notify_ticket_assigned', ticket_id=ticket.id, user_id=assigned_user.id)
 
 def notify_status_changed(ticket, old_status, new_status):
-    """Notify ticket creator about status change"""
-    create_notification(
-        ticket.user_id,
-        ticket.id,
-        'status_changed',
-        f'Your ticket "{ticket.subject}" status changed from {old_status.replace("_", " ").title()} to {new_status.replace("_", " ").title()}'
-    )
+    """Queue a notification to the ticket creator about a status change"""
+    enqueue_job('notify_status_changed', ticket_id=ticket.id, old_status=old_status, new_status=new_status)
 
 def notify_comment_added(comment):
+    """Queue notifications to relevant users about a new comment"""
+    enqueue_job('notify_comment_added', comment_id=comment.id)
+
+@job_handler('notify_ticket_created')
+def deliver_ticket_created(ticket_id):
+    """Notify admins and agents about new ticket"""
+    ticket = db.session.get(Ticket, ticket_id)
+    if ticket is None:
+        return
+    
+    create_broadcast('staff', ticket.id, 'ticket_created', actor_id=ticket.user_id)
+
+@job_handler('notify_ticket_assigned')
+def deliver_ticket_assigned(ticket_id, user_id):
+    """Notify user when ticket is assigned to them"""
+    ticket = db.session.get(Ticket, ticket_id)
+    if ticket is None:
+        return
+    
+    create_notification(user_id, ticket.id, 'ticket_assigned')
+
+@job_handler('notify_status_changed')
+def deliver_status_changed(ticket_id, old_status, new_status):
+    """Notify ticket creator about status change"""
+    ticket = db.session.get(Ticket, ticket_id)
+    if ticket is None:
+        return
+    
+    create_notification(ticket.user_id, ticket.id, 'status_changed', old_status=old_status, new_status=new_status)
+
+@job_handler('notify_comment_added')
+def deliver_comment_added(comment_id):
     """Notify relevant users about new comment"""
+    comment = db.session.get(Comment, comment_id)
+    if comment is None:
+        return
+    
     ticket = comment.ticket
+    rows = []
     
     # Notify ticket creator (if comment is not from them)
     if comment.user_id != ticket.user_id:
-        create_notification(
-            ticket.user_id,
-            ticket.id,
-            'comment_added',
-            f'New comment on your ticket "{ticket.subject}" by {comment.author.username}',
-            comment.id
-        )
+        rows.append(notification_row(ticket.user_id, ticket.id, 'comment_added', comment.user_id, comment.id))
     
     # Notify assigned agent (if different from commenter and ticket creator)
     if ticket.assigned_to and ticket.assigned_to != comment.user_id and ticket.assigned_to != ticket.user_id:
-        create_notification(
-            ticket.assigned_to,
-            ticket.id,
-            'comment_added',
-            f'New comment on assigned ticket "{ticket.subject}" by {comment.author.username}',
-            comment.id
-        )
+        rows.append(notification_row(
+            ticket.assigned_to, ticket.id, 'comment_added', comment.user_id, comment.id, reason='assignee'
+        ))
     
     # Notify admins about comments on important tickets
     if ticket.priority in ['high', 'urgent']:
-        admins = User.query.filter_by(role='admin').all()
-        for admin in admins:
-            if admin.id != comment.user_id:
-                create_notification(
-                    admin.id,
-                    ticket.id,
-                    'comment_added',
-                    f'New comment on {ticket.priority} priority ticket "{ticket.subject}" by {comment.author.username}',
-                    comment.id
-                )
+        for admin_id in role_member_ids('admin'):
+            if admin_id != comment.user_id:
+                rows.append(notification_row(
+                    admin_id, ticket.id, 'comment_added', comment.user_id, comment.id, reason='priority'
+                ))
+    
+    create_notifications(rows)
+
+def with_ticket_list_options(query):
+    """Load what a ticket list row shows with the tickets themselves
+
+    Author and category are joined in, and attachment and comment counts come
+    from correlated subqueries, so a page of tickets is a single query.
+    """
+    return query.options(
+        db.joinedload(Ticket.author),
+        db.joinedload(Ticket.category),
+        db.with_expression(
+            Ticket.attachment_count,
+            db.select(db.func.count(Attachment.id)).where(Attachment.ticket_id == Ticket.id).scalar_subquery()
+        ),
+        db.with_expression(
+            Ticket.comment_count,
+            db.select(db.func.count(Comment.id)).where(Comment.ticket_id == Ticket.id).scalar_subquery()
+        ),
+    )
+
+def ticket_list_query(user, status=None, category_id=None, search=None, sort=None, queue=None):
+    """Tickets user can see matching the dashboard filters, and their sort keys
+
+    queue narrows staff lists to a work queue: 'mine' or 'unassigned'.
+    Returns (query, keys) for keyset_paginate(); the keys end in the primary
+    key so the order is unique.
+    """
+    query = Ticket.query
+    
+    if user.role == 'user':
+        query = query.filter_by(user_id=user.id)
+    elif queue == 'mine':
+        query = query.filter(Ticket.assigned_to == user.id, Ticket.status.in_(ACTIVE_STATUSES))
+    elif queue == 'unassigned':
+        query = query.filter(Ticket.assigned_to.is_(None), Ticket.status == 'open')
+    
+    if status:
+        query = query.filter_by(status=status)
+    
+    if category_id:
+        query = query.filter_by(category_id=category_id)
+    
+    rank = None
+    if search:
+        query, rank = search_tickets(query, search)
+    
+    if sort == 'relevance' and rank is not None:
+        # bm25() is lower for better matches
+        keys = [(rank, False, float), (Ticket.id, False, int)]
+    elif sort == 'priority':
+        keys = [
+            (Ticket.priority_rank, True, int),
+            (Ticket.updated_at, True, datetime),
+            (Ticket.id, True, int),
+        ]
+    else:
+        keys = [(Ticket.updated_at, True, datetime), (Ticket.id, True, int)]
+    return query, keys
 
 # Jinja filter for nl2br
 @app.template_filter('nl2br')
@@ -143,7 +1696,9 @@ class User(UserMixin, db.Model):
     tickets = db.relationship('Ticket', backref='author', lazy=True, foreign_keys='Ticket.user_id')
     assigned_tickets = db.relationship('Ticket', backref='assigned_agent', lazy=True, foreign_keys='Ticket.assigned_to')
     comments = db.relationship('Comment', backref='author', lazy=True)
-    notifications = db.relationship('Notification', backref='user', lazy=True, order_by='Notification.created_at.desc()')
+    # Dynamic so the full history is never loaded by accident; use fetch_notifications()
+    notifications = db.relationship('Notification', backref='user', lazy='dynamic', foreign_keys='Notification.user_id', order_by='Notification.created_at.desc()')
+    notification_state = db.relationship('NotificationState', uselist=False, cascade='all, delete-orphan')
 
 class Category(db.Model):
     id = db.Column(db.Integer, primary_key=True)
@@ -152,23 +1707,61 @@ class Category(db.Model):
     created_at = db.Column(db.DateTime, default=datetime.utcnow)
     tickets = db.relationship('Ticket', backref='category', lazy=True)
 
+# Priorities are stored as ranks so they sort with an index; names are only
+# used in forms, templates and messages. 0 marks a row not yet backfilled.
+PRIORITY_RANKS = {'low': 1, 'medium': 2, 'high': 3, 'urgent': 4}
+PRIORITY_NAMES = {rank: name for name, rank in PRIORITY_RANKS.items()}
+
 class Ticket(db.Model):
     id = db.Column(db.Integer, primary_key=True)
     subject = db.Column(db.String(200), nullable=False)
     description = db.Column(db.Text, nullable=False)
-    status = db.Column(db.String(20), default='open')  # open, in_progress, resolved, closed
-    priority = db.Column(db.String(20), default='medium')  # low, medium, high, urgent
+    # Work queue counts need the old values of status, category_id and
+    # assigned_to, so setting them loads the old value if it was expired
+    status = db.column_property(db.Column(db.String(20), default='open'), active_history=True)  # open, in_progress, resolved, closed
+    priority_rank = db.Column(db.SmallInteger, nullable=False, default=PRIORITY_RANKS['medium'], server_default='0')
     created_at = db.Column(db.DateTime, default=datetime.utcnow)
     updated_at = db.Column(db.DateTime, default=datetime.utcnow, onupdate=datetime.utcnow)
     user_id = db.Column(db.Integer, db.ForeignKey('user.id'), nullable=False)
-    category_id = db.Column(db.Integer, db.ForeignKey('category.id'), nullable=False)
-    assigned_to = db.Column(db.Integer, db.ForeignKey('user.id'))
+    category_id = db.column_property(db.Column(db.Integer, db.ForeignKey('category.id'), nullable=False), active_history=True)
+    assigned_to = db.column_property(db.Column(db.Integer, db.ForeignKey('user.id')), active_history=True)
     upvotes = db.Column(db.Integer, default=0)
     downvotes = db.Column(db.Integer, default=0)
     
     # Relationships
     comments = db.relationship('Comment', backref='ticket', lazy=True, order_by='Comment.created_at')
     attachments = db.relationship('Attachment', backref='ticket', lazy=True)
+    
+    # Filled in by with_ticket_list_options() for ticket lists
+    attachment_count = db.query_expression()
+    comment_count = db.query_expression()
+    
+    @property
+    def priority(self):
+        """Priority name: low, medium, high or urgent"""
+        return PRIORITY_NAMES.get(self.priority_rank, 'medium')
+    
+    @priority.setter
+    def priority(self, name):
+        if name not in PRIORITY_RANKS:
+            raise ValueError(f'Unknown priority {name!r}')
+        self.priority_rank = PRIORITY_RANKS[name]
+    
+    # Every list ends in (updated_at, id), the dashboard's keyset order, so a
+    # filtered page is read in index order; see ticket_query_plans()
+    __table_args__ = (
+        db.Index('ix_ticket_updated', 'updated_at', 'id'),
+        db.Index('ix_ticket_user_updated', 'user_id', 'updated_at', 'id'),
+        db.Index('ix_ticket_status_updated', 'status', 'updated_at', 'id'),
+        db.Index('ix_ticket_category_updated', 'category_id', 'updated_at', 'id'),
+        # Work queues: an agent's active tickets, and open unassigned ones by priority
+        db.Index('ix_ticket_queue_updated', 'assigned_to', 'status', 'updated_at', 'id'),
+        db.Index('ix_ticket_queue_priority', 'assigned_to', 'status', 'priority_rank', 'updated_at', 'id'),
+        db.Index('ix_ticket_priority_updated', 'priority_rank', 'updated_at', 'id'),
+        db.Index('ix_ticket_user_priority_updated', 'user_id', 'priority_rank', 'updated_at', 'id'),
+        # Covers the ticket_stats() GROUP BY
+        db.Index('ix_ticket_status_category', 'status', 'category_id'),
+    )
 
 class Comment(db.Model):
     id = db.Column(db.Integer, primary_key=True)
@@ -176,6 +1769,10 @@ class Comment(db.Model):
     created_at = db.Column(db.DateTime, default=datetime.utcnow)
     user_id = db.Column(db.Integer, db.ForeignKey('user.id'), nullable=False)
     ticket_id = db.Column(db.Integer, db.ForeignKey('ticket.id'), nullable=False)
+    
+    __table_args__ = (
+        db.Index('ix_comment_ticket_created', 'ticket_id', 'created_at'),
+    )
 
 class Attachment(db.Model):
     id = db.Column(db.Integer, primary_key=True)
@@ -184,6 +1781,10 @@ class Attachment(db.Model):
     file_path = db.Column(db.String(500), nullable=False)
     created_at = db.Column(db.DateTime, default=datetime.utcnow)
     ticket_id = db.Column(db.Integer, db.ForeignKey('ticket.id'), nullable=False)
+    
+    __table_args__ = (
+        db.Index('ix_attachment_ticket', 'ticket_id'),
+    )
 
 class Notification(db.Model):
     id = db.Column(db.Integer, primary_key=True)
@@ -191,13 +1792,369 @@ class Notification(db.Model):
     ticket_id = db.Column(db.Integer, db.ForeignKey('ticket.id'), nullable=False)
     comment_id = db.Column(db.Integer, db.ForeignKey('comment.id'))
     type = db.Column(db.String(50), nullable=False)  # ticket_created, ticket_updated, comment_added, ticket_assigned, status_changed
-    message = db.Column(db.Text, nullable=False)
+    actor_id = db.Column(db.Integer, db.ForeignKey('user.id'))  # who caused the event
+    params = db.Column(db.Text)  # JSON parameters for NOTIFICATION_MESSAGES
+    # Text of notifications created before messages were rendered on read
+    stored_message = db.Column('message', db.Text, nullable=False, default='', server_default='')
     is_read = db.Column(db.Boolean, default=False)
+    event_count = db.Column(db.Integer, nullable=False, default=1, server_default='1')  # events coalesced into this row
     created_at = db.Column(db.DateTime, default=datetime.utcnow)
     
     # Relationships
     ticket = db.relationship('Ticket', backref='notifications')
     comment = db.relationship('Comment', backref='notifications')
+    actor = db.relationship('User', foreign_keys=[actor_id])
+    
+    @property
+    def message(self):
+        return self.stored_message or render_notification_message(
+            self.type, self.ticket, self.actor, json.loads(self.params) if self.params else None
+        )
+    
+    # Tie-break between direct and broadcast notifications created together
+    kind = 'direct'
+    kind_rank = 1
+    
+    __table_args__ = (
+        db.Index('ix_notification_user_created', 'user_id', 'created_at', 'id'),
+        db.Index('ix_notification_user_unread', 'user_id', 'is_read', 'created_at'),
+        db.Index('ix_notification_coalesce', 'ticket_id', 'type', 'is_read', 'user_id'),
+        db.Index('ix_notification_created', 'created_at'),
+    )
+
+# One unread row per user, ticket and coalesced type, so concurrent writers
+# can't both add one. MySQL has no partial indexes and goes without.
+db.Index(
+    'ux_notification_unread_coalesce',
+    Notification.user_id, Notification.ticket_id, Notification.type,
+    unique=True,
+    sqlite_where=db.and_(Notification.is_read == False, Notification.type.in_(sorted(COALESCED_NOTIFICATION_TYPES))),
+    postgresql_where=db.and_(Notification.is_read == False, Notification.type.in_(sorted(COALESCED_NOTIFICATION_TYPES))),
+).ddl_if(dialect=('sqlite', 'postgresql'))
+
+class NotificationArchive(db.Model):
+    # Notifications moved out of the live tables by prune_notifications
+    id = db.Column(db.Integer, primary_key=True)
+    original_id = db.Column(db.Integer, nullable=False)
+    user_id = db.Column(db.Integer, index=True)  # None for broadcasts
+    audience = db.Column(db.String(20))  # set for broadcasts
+    ticket_id = db.Column(db.Integer, nullable=False)
+    comment_id = db.Column(db.Integer)
+    type = db.Column(db.String(50), nullable=False)
+    message = db.Column(db.Text, nullable=False)
+    is_read = db.Column(db.Boolean)
+    event_count = db.Column(db.Integer, nullable=False, default=1)
+    created_at = db.Column(db.DateTime)
+    archived_at = db.Column(db.DateTime, default=datetime.utcnow)
+
+class BroadcastNotification(db.Model):
+    # One row per role-wide event, shared by every user in the audience
+    id = db.Column(db.Integer, primary_key=True)
+    audience = db.Column(db.String(20), nullable=False)  # key of BROADCAST_AUDIENCES
+    ticket_id = db.Column(db.Integer, db.ForeignKey('ticket.id'), nullable=False)
+    type = db.Column(db.String(50), nullable=False)
+    actor_id = db.Column(db.Integer, db.ForeignKey('user.id'))
+    params = db.Column(db.Text)
+    stored_message = db.Column('message', db.Text, nullable=False, default='', server_default='')
+    created_at = db.Column(db.DateTime, default=datetime.utcnow)
+    
+    ticket = db.relationship('Ticket')
+    actor = db.relationship('User')
+    
+    message = Notification.message
+    
+    kind = 'broadcast'
+    kind_rank = 0
+    event_count = 1
+    # Set per reader from their watermark by fetch_notifications
+    is_read = False
+    
+    __table_args__ = (
+        db.Index('ix_broadcast_audience_created', 'audience', 'created_at', 'id'),
+        db.Index('ix_broadcast_audience_id', 'audience', 'id'),
+        db.Index('ix_broadcast_created', 'created_at'),
+    )
+
+class NotificationState(db.Model):
+    # Denormalized per-user counter, maintained in the same transaction as the
+    # notification writes so reading the unread count is a primary key lookup
+    user_id = db.Column(db.Integer, db.ForeignKey('user.id'), primary_key=True)
+    unread_count = db.Column(db.Integer, nullable=False, default=0)
+    # Broadcasts with ids up to this one count as read
+    broadcast_read_id = db.Column(db.Integer, nullable=False, default=0, server_default='0')
+    # Bumped whenever unread_count or broadcast_read_id changes; used for ETags
+    version = db.Column(db.Integer, nullable=False, default=0, server_default='0')
+
+class OutgoingEmail(db.Model):
+    id = db.Column(db.Integer, primary_key=True)
+    recipients = db.Column(db.Text, nullable=False)  # comma-separated addresses
+    subject = db.Column(db.String(200), nullable=False)
+    body = db.Column(db.Text, nullable=False)
+    status = db.Column(db.String(20), nullable=False, default='queued')  # queued, sent, failed
+    last_error = db.Column(db.Text)
+    created_at = db.Column(db.DateTime, default=datetime.utcnow)
+    sent_at = db.Column(db.DateTime)
+
+class CacheVersion(db.Model):
+    name = db.Column(db.String(50), primary_key=True)
+    token = db.Column(db.String(32), nullable=False)  # replaced whenever the cached data changes
+
+class QueueCount(db.Model):
+    queue = db.Column(db.String(50), primary_key=True)  # agent:<user id>, unassigned or unassigned:<category id>
+    count = db.Column(db.Integer, nullable=False, default=0)  # kept current by maintain_queue_counts()
+
+class Job(db.Model):
+    id = db.Column(db.Integer, primary_key=True)
+    name = db.Column(db.String(100), nullable=False)
+    payload = db.Column(db.Text, nullable=False, default='{}')  # JSON keyword arguments for the handler
+    status = db.Column(db.String(20), nullable=False, default='queued')  # queued, running, failed
+    attempts = db.Column(db.Integer, nullable=False, default=0)
+    max_attempts = db.Column(db.Integer, nullable=False, default=5)
+    run_at = db.Column(db.DateTime, nullable=False, default=datetime.utcnow)
+    locked_until = db.Column(db.DateTime)
+    last_error = db.Column(db.Text)
+    created_at = db.Column(db.DateTime, default=datetime.utcnow)
+    
+    __table_args__ = (
+        db.Index('ix_job_status_run_at', 'status', 'run_at'),
+    )
+
+# Full-text ticket search
+# On SQLite, ticket_search is an FTS5 index with one row per ticket (rowid is
+# the ticket id) holding its subject, description and all comment text. The
+# triggers below keep it in step with every insert, update and delete, so it
+# never needs a separate indexing job. Other databases fall back to LIKE.
+TICKET_SEARCH_DDL = [
+    # Prefix indexes make the short prefixes typed into suggest_tickets() cheap
+    """CREATE VIRTUAL TABLE IF NOT EXISTS ticket_search USING fts5(
+        subject, description, comments, prefix = '2 3 4', tokenize = 'unicode61 remove_diacritics 2'
+    )""",
+    """CREATE TRIGGER IF NOT EXISTS ticket_search_ai AFTER INSERT ON ticket BEGIN
+        INSERT INTO ticket_search (rowid, subject, description, comments)
+        VALUES (new.id, new.subject, new.description, '');
+    END""",
+    """CREATE TRIGGER IF NOT EXISTS ticket_search_au AFTER UPDATE OF subject, description ON ticket BEGIN
+        UPDATE ticket_search SET subject = new.subject, description = new.description WHERE rowid = new.id;
+    END""",
+    """CREATE TRIGGER IF NOT EXISTS ticket_search_ad AFTER DELETE ON ticket BEGIN
+        DELETE FROM ticket_search WHERE rowid = old.id;
+    END""",
+]
+# Documents per indexed word, for weighting words in find_duplicate_tickets()
+TICKET_SEARCH_DDL.append(
+    "CREATE VIRTUAL TABLE IF NOT EXISTS ticket_search_terms USING fts5vocab(ticket_search, 'row')"
+)
+# Comment changes rewrite the ticket's comment text from the comment table
+TICKET_SEARCH_DDL += [
+    f"""CREATE TRIGGER IF NOT EXISTS ticket_search_comment_{name} AFTER {event} ON comment BEGIN
+        UPDATE ticket_search
+        SET comments = (SELECT coalesce(group_concat(content, ' '), '') FROM comment WHERE ticket_id = {row}.ticket_id)
+        WHERE rowid = {row}.ticket_id;
+    END"""
+    for name, event, row in [('ai', 'INSERT', 'new'), ('au', 'UPDATE OF content', 'new'), ('ad', 'DELETE', 'old')]
+]
+
+# Column weights for bm25(): a subject match outranks description and comments
+TICKET_SEARCH_WEIGHTS = (10.0, 4.0, 1.0)
+
+def ticket_search_enabled():
+    return db.engine.dialect.name == 'sqlite'
+
+def rebuild_ticket_search(connection):
+    """Recreate the search index from the ticket and comment tables"""
+    connection.execute(db.text('DELETE FROM ticket_search'))
+    connection.execute(db.text(
+        "INSERT INTO ticket_search (rowid, subject, description, comments) "
+        "SELECT id, subject, description, "
+        "(SELECT coalesce(group_concat(content, ' '), '') FROM comment WHERE comment.ticket_id = ticket.id) "
+        "FROM ticket"
+    ))
+
+def create_ticket_search(target, connection, **kw):
+    if connection.dialect.name != 'sqlite':
+        return
+    definition = connection.execute(db.text(
+        "SELECT sql FROM sqlite_master WHERE type = 'table' AND name = 'ticket_search'"
+    )).scalar()
+    # FTS5 options can't be altered, so an index created with older ones is rebuilt
+    exists = definition is not None and (
+        definition.split() == TICKET_SEARCH_DDL[0].replace('IF NOT EXISTS ', '').split()
+    )
+    if definition is not None and not exists:
+        connection.execute(db.text('DROP TABLE ticket_search'))
+    for statement in TICKET_SEARCH_DDL:
+        connection.execute(db.text(statement))
+    if not exists:
+        rebuild_ticket_search(connection)
+
+def drop_ticket_search(target, connection, **kw):
+    if connection.dialect.name == 'sqlite':
+        connection.execute(db.text('DROP TABLE IF EXISTS ticket_search_terms'))
+        connection.execute(db.text('DROP TABLE IF EXISTS ticket_search'))
+
+# Comment is created after ticket, so both trigger targets exist by then
+db.event.listen(Comment.__table__, 'after_create', create_ticket_search)
+db.event.listen(Comment.__table__, 'before_drop', drop_ticket_search)
+
+def ticket_search_query(text):
+    """FTS5 query matching every word of text as a prefix; None if it has no words"""
+    words = re.findall(r'\w+', text)
+    if not words:
+        return None
+    return ' '.join(f'"{word}"*' for word in words)
+
+def suggest_tickets(user, text, limit=8):
+    """Newest tickets user can see whose subject has every word of text as a prefix
+
+    Returns (id, subject, status) rows for search-as-you-type. On SQLite the
+    subject column of ticket_search answers prefix queries from its prefix
+    indexes, and reading it newest rowid first stops after limit matches
+    rather than ranking them all. Customers' queries start from their own
+    tickets instead, most recently updated first, checking each against the
+    index. Words shorter than two characters are ignored, since a one letter
+    prefix matches most tickets.
+    """
+    words = [word for word in re.findall(r'\w+', text) if len(word) >= 2]
+    if not words:
+        return []
+    query = db.select(Ticket.id, Ticket.subject, Ticket.status).order_by(Ticket.id.desc()).limit(limit)
+    if user.role == 'user':
+        query = query.where(Ticket.user_id == user.id)
+    
+    if not ticket_search_enabled():
+        return db.session.execute(
+            query.where(*[Ticket.subject.contains(word) for word in words])
+        ).all()
+    
+    match = f'subject : ({ticket_search_query(" ".join(words))})'
+    if user.role == 'user':
+        # Read in the (user_id, updated_at, id) index order rather than sorting
+        query = query.where(db.text(
+            'EXISTS (SELECT 1 FROM ticket_search WHERE ticket_search MATCH :match AND ticket_search.rowid = ticket.id)'
+        ).bindparams(match=match)).order_by(None).order_by(Ticket.updated_at.desc(), Ticket.id.desc())
+    else:
+        matches = db.text(
+            'SELECT rowid AS ticket_id FROM ticket_search WHERE ticket_search MATCH :match'
+        ).bindparams(match=match).columns(ticket_id=db.Integer).subquery('ticket_matches')
+        query = query.join(matches, matches.c.ticket_id == Ticket.id).order_by(None).order_by(matches.c.ticket_id.desc())
+    return db.session.execute(query).all()
+
+# Duplicate detection
+# Candidates are found through the rarest few words of the new ticket, so a
+# lookup reads a handful of short posting lists in ticket_search however many
+# tickets there are; only they are then scored in full.
+DUPLICATE_SEARCH_WORDS = 6
+DUPLICATE_CANDIDATES = 20
+
+def ticket_words(text):
+    """Lowercase words of text, without diacritics, as ticket_search indexes them"""
+    text = ''.join(c for c in unicodedata.normalize('NFKD', text.lower()) if not unicodedata.combining(c))
+    return {word for word in re.findall(r'\w+', text) if len(word) >= 3}
+
+def _weighted_jaccard(words, other, weights):
+    union = sum(weights[word] for word in words | other)
+    return sum(weights[word] for word in words & other) / union if union else 0.0
+
+def _document_counts(words):
+    """{word: tickets containing it} from ticket_search; empty without the index"""
+    if not words or not ticket_search_enabled():
+        return {}
+    return dict(db.session.execute(
+        db.text('SELECT term, doc FROM ticket_search_terms WHERE term IN :terms')
+        .bindparams(db.bindparam('terms', expanding=True)),
+        {'terms': sorted(words)}
+    ).all())
+
+def duplicate_candidates(user, words):
+    """Up to DUPLICATE_CANDIDATES active tickets user can see containing any of words, best match first"""
+    if not words:
+        return []
+    query = Ticket.query.filter(Ticket.status.in_(ACTIVE_STATUSES))
+    if user.role == 'user':
+        query = query.filter(Ticket.user_id == user.id)
+    
+    if not ticket_search_enabled():
+        query = query.filter(db.or_(*[Ticket.subject.contains(word) for word in words])).order_by(Ticket.id.desc())
+        return query.limit(DUPLICATE_CANDIDATES).all()
+    
+    # Comments don't describe the issue itself, so only subject and description count
+    match = '{subject description} : (' + ' OR '.join(f'"{word}"' for word in words) + ')'
+    weights = ', '.join(str(weight) for weight in TICKET_SEARCH_WEIGHTS[:2])
+    matches = db.text(
+        f'SELECT rowid AS ticket_id, bm25(ticket_search, {weights}, 0.0) AS rank '
+        'FROM ticket_search WHERE ticket_search MATCH :match'
+    ).bindparams(match=match).columns(ticket_id=db.Integer, rank=db.Float).subquery('duplicate_matches')
+    return query.join(matches, matches.c.ticket_id == Ticket.id).order_by(matches.c.rank).limit(DUPLICATE_CANDIDATES).all()
+
+def find_duplicate_tickets(user, subject, description='', limit=5, threshold=None):
+    """Active tickets user can see that look like the same issue
+
+    Returns [(ticket, score)] best first. The score is an IDF-weighted
+    Jaccard similarity between 0 and 1, taken over the subjects alone or over
+    subject and description together, whichever is higher; only scores of at
+    least threshold (default TICKET_DUPLICATE_THRESHOLD) are returned.
+    """
+    if threshold is None:
+        threshold = app.config['TICKET_DUPLICATE_THRESHOLD']
+    subject_words = ticket_words(subject or '')
+    words = subject_words | ticket_words(description or '')
+    if not words:
+        return []
+    
+    counts = _document_counts(words)
+    rarest = sorted(words, key=lambda word: (counts.get(word, 0), word))
+    if ticket_search_enabled():
+        # Words no ticket contains can't find candidates
+        rarest = [word for word in rarest if counts.get(word)]
+    candidates = duplicate_candidates(user, rarest[:DUPLICATE_SEARCH_WORDS])
+    if not candidates:
+        return []
+    
+    candidate_words = {
+        ticket.id: (ticket_words(ticket.subject), ticket_words(f'{ticket.subject} {ticket.description}'))
+        for ticket in candidates
+    }
+    vocabulary = set(words).union(*[all_words for _, all_words in candidate_words.values()])
+    counts.update(_document_counts(vocabulary - set(counts)))
+    total = db.session.execute(db.select(db.func.max(Ticket.id))).scalar() or 1
+    weights = {word: math.log((total + 1) / (counts.get(word, 0) + 1)) + 1 for word in vocabulary}
+    
+    scored = []
+    for ticket in candidates:
+        other_subject, other_words = candidate_words[ticket.id]
+        score = max(
+            _weighted_jaccard(subject_words, other_subject, weights),
+            _weighted_jaccard(words, other_words, weights),
+        )
+        if score >= threshold:
+            scored.append((ticket, score))
+    scored.sort(key=lambda pair: -pair[1])
+    return scored[:limit]
+
+def search_tickets(query, text):
+    """Filter a Ticket query to tickets matching text in subject, description or comments
+
+    Returns the query and a relevance column to order by, lower is better. On
+    SQLite this is an FTS5 match ranked by BM25. Elsewhere it is a LIKE on
+    the same fields and the relevance column is None.
+    """
+    if not ticket_search_enabled():
+        return query.filter(
+            Ticket.subject.contains(text) |
+            Ticket.description.contains(text) |
+            Ticket.comments.any(Comment.content.contains(text))
+        ), None
+    
+    match = ticket_search_query(text)
+    if match is None:
+        # Text without words matches nothing rather than every ticket
+        return query.filter(db.false()), None
+    weights = ', '.join(str(weight) for weight in TICKET_SEARCH_WEIGHTS)
+    matches = db.text(
+        f'SELECT rowid AS ticket_id, bm25(ticket_search, {weights}) AS rank '
+        'FROM ticket_search WHERE ticket_search MATCH :match'
+    ).bindparams(match=match).columns(ticket_id=db.Integer, rank=db.Float).subquery('ticket_matches')
+    return query.join(matches, matches.c.ticket_id == Ticket.id), matches.c.rank
 
 @login_manager.user_loader
 def load_user(user_id):
@@ -296,36 +2253,52 @@ def dashboard():
     status_filter = request.args.get('status', '')
     category_filter = request.args.get('category', '')
     search_query = request.args.get('search', '')
-    sort_by = request.args.get('sort', 'updated_at')
-    
-    # Build query
-    query = Ticket.query
-    
-    if current_user.role == 'user':
-        query = query.filter_by(user_id=current_user.id)
-    
-    if status_filter:
-        query = query.filter_by(status=status_filter)
+    queue = request.args.get('queue', '') if current_user.role != 'user' else ''
+    default_sort = 'relevance' if search_query else 'priority' if queue == 'unassigned' else 'updated_at'
+    sort_by = request.args.get('sort', default_sort)
+    if sort_by == 'relevance' and not search_query:
+        sort_by = default_sort
+    filters = dict(
+        status=status_filter, category_id=category_filter, search=search_query, sort=sort_by, queue=queue
+    )
     
-    if category_filter:
-        query = query.filter_by(category_id=category_filter)
+    stats = ticket_stats(current_user)
+    categories = Category.query.all()
+    tickets = ticket_page(current_user, cursor=request.args.get('cursor'), **filters)
     
-    if search_query:
-        query = query.filter(Ticket.subject.contains(search_query) | Ticket.description.contains(search_query))
+    # Work queue sizes for the staff sidebar
+    queues = None
+    if current_user.role != 'user':
+        queues = queue_counts(
+            f'agent:{current_user.id}', 'unassigned', *[f'unassigned:{category.id}' for category in categories]
+        )
     
-    # Sorting
-    if sort_by == 'recent':
-        query = query.order_by(Ticket.updated_at.desc())
-    elif sort_by == 'priority':
-        priority_order = {'urgent': 4, 'high': 3, 'medium': 2, 'low': 1}
-        query = query.order_by(db.case(priority_order, value=Ticket.priority).desc())
-    else:
-        query = query.order_by(Ticket.updated_at.desc())
+    # Status, category and queue totals come from cached or maintained counts;
+    # counting search matches costs as much as the search, so it only runs on request
+    if request.args.get('count'):
+        query, _ = ticket_list_query(current_user, **filters)
+        tickets.total = query.order_by(None).count()
+    elif queue == 'mine' and not (status_filter or category_filter or search_query):
+        tickets.total = queues[f'agent:{current_user.id}']
+    elif queue == 'unassigned' and not (status_filter or search_query):
+        tickets.total = queues.get(f'unassigned:{category_filter}' if category_filter else 'unassigned')
+    elif not (queue or search_query):
+        tickets.total = ticket_total(stats, status_filter, category_filter)
+    recent_notifications, _ = fetch_notifications(current_user, limit=5)
     
-    tickets = query.paginate(page=request.args.get('page', 1, type=int), per_page=10)
-    categories = Category.query.all()
+    # Filters carried over into the page links
+    page_args = {key: value for key, value in request.args.items() if key not in ('cursor', 'page', 'count')}
     
-    return render_template('dashboard.html', tickets=tickets, categories=categories)
+    return render_template(
+        'dashboard.html',
+        tickets=tickets,
+        page_args=page_args,
+        sort_by=sort_by,
+        categories=categories,
+        stats=stats,
+        queues=queues,
+        recent_notifications=recent_notifications
+    )
 
 @app.route('/ticket/new', methods=['GET', 'POST'])
 @login_required
@@ -335,12 +2308,26 @@ def new_ticket():
         description = request.form.get('description')
         category_id = request.form.get('category_id')
         priority = request.form.get('priority', 'medium')
+        if priority not in PRIORITY_RANKS:
+            priority = 'medium'
         
         # Validation
         if not subject or not description or not category_id:
             flash('Please fill in all required fields', 'error')
             categories = Category.query.all()
-            return render_template('new_ticket.html', categories=categories)
+            return render_template('new_ticket.html', categories=categories, duplicates=[])
+        
+        # Offer likely duplicates once before filing another copy
+        if not request.form.get('confirm_duplicate'):
+            duplicates = find_duplicate_tickets(current_user, subject, description)
+            if duplicates:
+                flash('This looks like an existing ticket. Check the matches below, or submit again to create it anyway.', 'warning')
+                categories = Category.query.all()
+                # Browsers can't refill a file input, so name the uploads to attach again
+                dropped = [file.filename for file in request.files.getlist('attachments') if file.filename]
+                return render_template(
+                    'new_ticket.html', categories=categories, duplicates=duplicates, dropped_attachments=dropped
+                )
         
         ticket = Ticket(
             subject=subject,
@@ -377,7 +2364,7 @@ def new_ticket():
         return redirect(url_for('ticket_detail', ticket_id=ticket.id))
     
     categories = Category.query.all()
-    return render_template('new_ticket.html', categories=categories)
+    return render_template('new_ticket.html', categories=categories, duplicates=[])
 
 @app.route('/ticket/<int:ticket_id>')
 @login_required
@@ -389,7 +2376,18 @@ def ticket_detail(ticket_id):
         flash('You do not have permission to view this ticket', 'error')
         return redirect(url_for('dashboard'))
     
-    return render_template('ticket_detail.html', ticket=ticket)
+    # Viewing a ticket counts as reading its notifications
+    if app.config['NOTIFICATION_AUTO_READ_ON_VIEW']:
+        if mark_notifications_read(current_user.id, Notification.ticket_id == ticket.id):
+            db.session.commit()
+        else:
+            db.session.rollback()
+    
+    agents = []
+    if current_user.role in ['agent', 'admin']:
+        agents = User.query.filter(User.role.in_(['agent', 'admin'])).order_by(User.username).all()
+    
+    return render_template('ticket_detail.html', ticket=ticket, agents=agents)
 
 @app.route('/ticket/<int:ticket_id>/comment', methods=['POST'])
 @login_required
@@ -446,6 +2444,35 @@ def update_ticket_status(ticket_id):
     
     return redirect(url_for('ticket_detail', ticket_id=ticket_id))
 
+@app.route('/ticket/<int:ticket_id>/assign', methods=['POST'])
+@login_required
+def assign_ticket(ticket_id):
+    ticket = Ticket.query.get_or_404(ticket_id)
+    
+    # Only agents and admins can assign tickets
+    if current_user.role not in ['agent', 'admin']:
+        flash('You do not have permission to assign tickets', 'error')
+        return redirect(url_for('ticket_detail', ticket_id=ticket_id))
+    
+    assignee = None
+    assigned_to = request.form.get('assigned_to', '')
+    if assigned_to:
+        assignee = db.session.get(User, request.form.get('assigned_to', type=int) or 0)
+        if assignee is None or assignee.role not in ['agent', 'admin']:
+            flash('Tickets can only be assigned to agents and admins', 'error')
+            return redirect(url_for('ticket_detail', ticket_id=ticket_id))
+    
+    if ticket.assigned_to != (assignee.id if assignee else None):
+        ticket.assigned_to = assignee.id if assignee else None
+        ticket.updated_at = datetime.utcnow()
+        db.session.commit()
+        
+        if assignee and assignee.id != current_user.id:
+            notify_ticket_assigned(ticket, assignee)
+        flash('Ticket assignment updated successfully!', 'success')
+    
+    return redirect(url_for('ticket_detail', ticket_id=ticket_id))
+
 @app.route('/ticket/<int:ticket_id>/vote', methods=['POST'])
 @login_required
 def vote_ticket(ticket_id):
@@ -460,6 +2487,38 @@ def vote_ticket(ticket_id):
     db.session.commit()
     return jsonify({'upvotes': ticket.upvotes, 'downvotes': ticket.downvotes})
 
+@app.route('/api/tickets/suggest')
+@login_required
+def ticket_suggestions():
+    """Ticket subjects matching ?q= as it is typed"""
+    limit = max(1, min(request.args.get('limit', 8, type=int), 20))
+    rows = suggest_tickets(current_user, request.args.get('q', ''), limit)
+    return jsonify({
+        'suggestions': [{
+            'id': ticket_id,
+            'subject': subject,
+            'status': status,
+            'url': url_for('ticket_detail', ticket_id=ticket_id),
+        } for ticket_id, subject, status in rows],
+    })
+
+@app.route('/api/tickets/duplicates')
+@login_required
+def ticket_duplicates():
+    """Likely duplicates of a ticket being written, from ?subject= and ?description="""
+    duplicates = find_duplicate_tickets(
+        current_user, request.args.get('subject', ''), request.args.get('description', '')[:2000]
+    )
+    return jsonify({
+        'duplicates': [{
+            'id': ticket.id,
+            'subject': ticket.subject,
+            'status': ticket.status,
+            'score': round(score, 2),
+            'url': url_for('ticket_detail', ticket_id=ticket.id),
+        } for ticket, score in duplicates],
+    })
+
 @app.route('/uploads/<filename>')
 @login_required
 def uploaded_file(filename):
@@ -470,10 +2529,34 @@ def uploaded_file(filename):
 @login_required
 def notifications():
     """View all notifications for current user"""
-    page = request.args.get('page', 1, type=int)
-    notifications = Notification.query.filter_by(user_id=current_user.id).paginate(
-        page=page, per_page=20, error_out=False)
-    return render_template('notifications.html', notifications=notifications)
+    notifications, next_cursor = fetch_notifications(current_user, request.args.get('cursor'))
+    return render_template(
+        'notifications.html',
+        notifications=notifications,
+        next_cursor=next_cursor,
+        unread_count=unread_notification_count(current_user)
+    )
+
+@app.route('/api/notifications')
+@login_required
+def notifications_api():
+    """JSON page of notifications for infinite scroll"""
+    limit = max(1, min(request.args.get('limit', 20, type=int), 100))
+    notifications, next_cursor = fetch_notifications(current_user, request.args.get('cursor'), limit)
+    return jsonify({
+        'notifications': [{
+            'id': notification.id,
+            'kind': notification.kind,
+            'type': notification.type,
+            'message': notification.message,
+            'is_read': notification.is_read,
+            'event_count': notification.event_count,
+            'created_at': notification.created_at.strftime('%Y-%m-%d %H:%M'),
+            'ticket_url': url_for('ticket_detail', ticket_id=notification.ticket_id),
+            'position': notification_position(notification),
+        } for notification in notifications],
+        'next_cursor': next_cursor,
+    })
 
 @app.route('/notifications/mark-read/<int:notification_id>', methods=['POST'])
 @login_required
@@ -486,16 +2569,82 @@ def mark_notification_read(notification_id):
         flash('Access denied', 'error')
         return redirect(url_for('notifications'))
     
-    notification.is_read = True
+    # Conditional so concurrent requests can only decrement the counter once
+    mark_notifications_read(current_user.id, Notification.id == notification.id)
     db.session.commit()
     
     return jsonify({'success': True})
 
+@app.route('/notifications/broadcast/mark-read/<int:broadcast_id>', methods=['POST'])
+@login_required
+def mark_broadcast_read(broadcast_id):
+    """Mark a broadcast notification, and every older one, as read"""
+    broadcast = BroadcastNotification.query.get_or_404(broadcast_id)
+    
+    if broadcast.audience not in broadcast_audiences(current_user.role):
+        flash('Access denied', 'error')
+        return redirect(url_for('notifications'))
+    
+    mark_broadcasts_read(current_user, broadcast.id)
+    queue_notification_event(current_user.id)
+    db.session.commit()
+    
+    return jsonify({'success': True})
+
+@app.route('/api/notifications/mark-read', methods=['POST'])
+@login_required
+def mark_notifications_read_batch():
+    """Mark many notifications read with one UPDATE
+
+    Accepts JSON with any of: "ids" (direct notification ids), "up_to" (the
+    position of a notification; it and every direct notification below it in
+    the inbox) and "broadcast_up_to_id" (the broadcast read watermark, which
+    stops at the newest broadcast the user has been sent). A coalesced
+    notification moves to the top of the inbox when it takes a new event, so
+    an up_to taken before then leaves it unread.
+    """
+    data = request.get_json(silent=True) or {}
+    if not isinstance(data.get('ids', []), list):
+        return jsonify({'success': False, 'error': 'ids must be a list'}), 400
+    try:
+        ids = [int(notification_id) for notification_id in data.get('ids', [])][:1000]
+        broadcast_up_to_id = int(data['broadcast_up_to_id']) if data.get('broadcast_up_to_id') is not None else None
+    except (TypeError, ValueError):
+        return jsonify({'success': False, 'error': 'ids must be integers'}), 400
+    # SQLite integers are 64-bit, and larger values can't be bound
+    if any(abs(value) >= 2 ** 63 for value in ids + [broadcast_up_to_id or 0]):
+        return jsonify({'success': False, 'error': 'ids are out of range'}), 400
+    up_to = decode_cursor(data.get('up_to'), datetime, int, int) if data.get('up_to') is not None else None
+    if data.get('up_to') is not None and (up_to is None or abs(up_to[2]) >= 2 ** 63):
+        return jsonify({'success': False, 'error': 'up_to must be a notification position'}), 400
+    
+    marked = 0
+    if ids:
+        marked += mark_notifications_read(current_user.id, Notification.id.in_(ids))
+    if up_to is not None:
+        created_at, _, notification_id = up_to
+        marked += mark_notifications_read(current_user.id, db.or_(
+            _seek_before(Notification, Notification.kind_rank, up_to),
+            db.and_(Notification.created_at == created_at, Notification.id == notification_id)
+        ))
+    if broadcast_up_to_id is not None:
+        # A watermark past the newest broadcast would mark future ones read
+        mark_broadcasts_read(current_user, min(broadcast_up_to_id, latest_broadcast_id(current_user)))
+        queue_notification_event(current_user.id)
+    db.session.commit()
+    
+    return jsonify({'success': True, 'marked': marked, 'count': unread_notification_count(current_user)})
+
 @app.route('/notifications/mark-all-read', methods=['POST'])
 @login_required
 def mark_all_notifications_read():
     """Mark all notifications as read for current user"""
-    Notification.query.filter_by(user_id=current_user.id, is_read=False).update({'is_read': True})
+    mark_notifications_read(current_user.id)
+    latest = latest_broadcast_id(current_user)
+    if latest:
+        mark_broadcasts_read(current_user, latest)
+    
+    queue_notification_event(current_user.id)
     db.session.commit()
     
     flash('All notifications marked as read!', 'success')
@@ -504,9 +2653,99 @@ def mark_all_notifications_read():
 @app.route('/api/notifications/count')
 @login_required
 def notification_count():
-    """Get unread notification count for current user"""
-    count = Notification.query.filter_by(user_id=current_user.id, is_read=False).count()
-    return jsonify({'count': count})
+    """Get unread notification count for current user
+
+    Supports If-None-Match: an unchanged count is a 304 decided from the
+    user's counter version alone. With ?wait=<seconds> a request whose ETag
+    still matches is held until the count changes or the wait runs out.
+    """
+    user = current_user._get_current_object()
+    wait = max(0, min(request.args.get('wait', 0, type=float), app.config['NOTIFICATION_LONG_POLL_MAX']))
+    
+    # Subscribe before reading the ETag so no change can slip in between
+    subscription = notification_broker.subscribe(user.id, user.role) if wait else None
+    try:
+        etag = notification_count_etag(user)
+        deadline = time.monotonic() + wait
+        while request.if_none_match.contains(etag) and subscription is not None:
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                break
+            # Don't hold a read transaction open while waiting
+            db.session.rollback()
+            try:
+                subscription.get(timeout=remaining)
+            except queue.Empty:
+                pass
+            etag = notification_count_etag(user)
+    finally:
+        if subscription is not None:
+            notification_broker.unsubscribe(user.id, subscription)
+    
+    if request.if_none_match.contains(etag):
+        response = Response(status=304)
+    else:
+        response = jsonify({'count': unread_notification_count(user)})
+    response.set_etag(etag)
+    # Cached copies must always be revalidated
+    response.headers['Cache-Control'] = 'private, no-cache'
+    return response
+
+@app.route('/api/notifications/stream')
+@login_required
+def notification_stream():
+    """Server-Sent Events stream of the unread count and new notifications"""
+    user = current_user._get_current_object()
+    user_id = user.id
+    role = user.role
+    keepalive = app.config['NOTIFICATION_STREAM_KEEPALIVE']
+    
+    def unread_count():
+        count = unread_notification_count(user)
+        # Don't hold a read transaction open between events
+        db.session.rollback()
+        return count
+    
+    def message(count, notifications):
+        return f'event: notifications\ndata: {json.dumps({"count": count, "notifications": notifications})}\n\n'
+    
+    def generate():
+        subscription = notification_broker.subscribe(user_id, role)
+        try:
+            last_count = unread_count()
+            yield f'retry: {keepalive * 1000}\n'
+            yield message(last_count, [])
+            while True:
+                try:
+                    notifications = [subscription.get(timeout=keepalive)]
+                except queue.Empty:
+                    # Catches changes published by workers in other processes
+                    count = unread_count()
+                    if count != last_count:
+                        last_count = count
+                        yield message(count, [])
+                    else:
+                        yield ': keepalive\n\n'
+                    continue
+                
+                while True:
+                    try:
+                        notifications.append(subscription.get_nowait())
+                    except queue.Empty:
+                        break
+                notifications = [n for n in notifications if n is not None]
+                count = unread_count()
+                if notifications or count != last_count:
+                    last_count = count
+                    yield message(count, notifications)
+        finally:
+            notification_broker.unsubscribe(user_id, subscription)
+    
+    return Response(
+        stream_with_context(generate()),
+        mimetype='text/event-stream',
+        headers={'Cache-Control': 'no-cache', 'X-Accel-Buffering': 'no'}
+    )
 
 # Admin routes
 @app.route('/admin/users')
@@ -696,32 +2935,256 @@ def delete_category(category_id):
     flash('Category deleted successfully!', 'success')
     return redirect(url_for('admin_categories'))
 
+def upgrade_schema():
+    """Bring an existing database up to date with the models
+
+    create_all() only creates missing tables, so columns and indexes added to
+    existing tables are created here. New NOT NULL columns need a
+    server_default so existing rows can be filled in.
+    """
+    inspector = db.inspect(db.engine)
+    with db.engine.begin() as connection:
+        for table in db.metadata.sorted_tables:
+            existing = {column['name'] for column in inspector.get_columns(table.name)}
+            for column in table.columns:
+                if column.name not in existing:
+                    ddl = db.schema.CreateColumn(column).compile(dialect=db.engine.dialect)
+                    connection.execute(db.text(f'ALTER TABLE {table.name} ADD COLUMN {ddl}'))
+    
+    # Merge racing duplicates the unique index over unread notifications would refuse
+    if 'ux_notification_unread_coalesce' not in {index['name'] for index in inspector.get_indexes('notification')}:
+        merge_coalesced_duplicates()
+        db.session.commit()
+    
+    for table in db.metadata.sorted_tables:
+        for index in table.indexes:
+            index.create(db.engine, checkfirst=True)
+
+def backfill_priority_ranks(batch_size=500):
+    """Rank tickets created before priority_rank from the old priority names
+
+    Runs in batches of batch_size tickets per transaction, and leaves
+    updated_at alone so the backfill doesn't reorder the dashboard. Returns
+    the number of tickets ranked.
+    """
+    columns = {column['name'] for column in db.inspect(db.engine).get_columns('ticket')}
+    if 'priority' not in columns:
+        return 0
+    
+    ticket = Ticket.__table__
+    ranked = 0
+    while True:
+        ticket_ids = db.session.execute(
+            db.select(ticket.c.id).where(ticket.c.priority_rank == 0).order_by(ticket.c.id).limit(batch_size)
+        ).scalars().all()
+        if not ticket_ids:
+            break
+        db.session.execute(
+            db.update(ticket)
+            .where(ticket.c.id.in_(ticket_ids))
+            .values(
+                priority_rank=db.case(PRIORITY_RANKS, value=db.column('priority'), else_=PRIORITY_RANKS['medium']),
+                updated_at=ticket.c.updated_at,
+            )
+        )
+        db.session.commit()
+        ranked += len(ticket_ids)
+    return ranked
+
+def init_db():
+    """Create tables and seed default categories and the admin account"""
+    db.create_all()
+    upgrade_schema()
+    # create_all() only fires after_create for new tables; add the index to older databases
+    with db.engine.begin() as connection:
+        create_ticket_search(Comment.__table__, connection)
+    
+    backfill_priority_ranks()
+    
+    # Seed the work queue counts of databases from before they were kept
+    if QueueCount.query.first() is None:
+        rebuild_queue_counts()
+        db.session.commit()
+    
+    # Create default categories if none exist
+    if not Category.query.first():
+        default_categories = [
+            Category(name='Technical Support', description='Technical issues and problems'),
+            Category(name='General Inquiry', description='General questions and information'),
+            Category(name='Bug Report', description='Software bugs and issues'),
+            Category(name='Feature Request', description='New feature suggestions'),
+            Category(name='Account Issues', description='Account-related problems')
+        ]
+        for category in default_categories:
+            db.session.add(category)
+        db.session.commit()
+    
+    # Create admin user if none exists
+    if not User.query.filter_by(role='admin').first():
+        admin = User(
+            username='admin',
+            email='admin@quickdesk.com',
+            password_hash=generate_password_hash('admin123'),
+            role='admin'
+        )
+        db.session.add(admin)
+        db.session.commit()
+
+# Query plan checks
+# Each ticket query shape the app runs, as (name, run, allowed). run issues
+# the query; allowed lists plan steps accepted for that shape, such as the
+# sort a computed order can't avoid.
+def _ticket_query_shapes():
+    staff = User(id=0, role='agent')
+    customer = User(id=0, role='user')
+    
+    def page(user, **filters):
+        def run():
+            query, keys = ticket_list_query(user, **filters)
+            samples = {datetime: datetime.utcnow(), int: 0, float: 0.0}
+            cursor = encode_cursor('after', *[samples[type_] for _, _, type_ in keys])
+            keyset_paginate(with_ticket_list_options(query), keys, cursor)
+        return run
+    
+    return [
+        ('dashboard', page(staff), ()),
+        ('dashboard by status', page(staff, status='open'), ()),
+        ('dashboard by category', page(staff, category_id=1), ()),
+        ('dashboard by priority', page(staff, sort='priority'), ()),
+        ('dashboard search', page(staff, search='printer', sort='relevance'), ('USE TEMP B-TREE FOR ORDER BY',)),
+        ('customer dashboard', page(customer), ()),
+        ('customer dashboard by status', page(customer, status='open'), ()),
+        ('customer dashboard by priority', page(customer, sort='priority'), ()),
+        ('my queue', page(staff, queue='mine'), ('USE TEMP B-TREE FOR ORDER BY',)),
+        ('unassigned queue', page(staff, queue='unassigned', sort='priority'), ()),
+        ('unassigned queue by category', page(staff, queue='unassigned', category_id=1, sort='priority'), ()),
+        ('ticket suggestions', lambda: suggest_tickets(staff, 'printer ja'), ()),
+        ('customer ticket suggestions', lambda: suggest_tickets(customer, 'printer ja'), ()),
+        ('duplicate candidates', lambda: duplicate_candidates(staff, ['printer', 'jammed']), ('USE TEMP B-TREE FOR ORDER BY',)),
+        ('customer duplicate candidates', lambda: duplicate_candidates(customer, ['printer', 'jammed']), ('USE TEMP B-TREE FOR ORDER BY',)),
+        ('ticket stats', lambda: db.session.execute(ticket_stats_query(staff)).all(), ()),
+        ('customer ticket stats', lambda: db.session.execute(ticket_stats_query(customer)).all(), ()),
+        ('assigned tickets', lambda: Ticket.query.filter_by(assigned_to=0).all(), ()),
+        ('category tickets', lambda: Ticket.query.filter_by(category_id=0).all(), ()),
+        ('ticket comments', lambda: Comment.query.filter_by(ticket_id=0).order_by(Comment.created_at).all(), ()),
+        ('ticket attachments', lambda: Attachment.query.filter_by(ticket_id=0).all(), ()),
+    ]
+
+def plan_problems(plan, allowed=()):
+    """Steps of an EXPLAIN QUERY PLAN that read a whole table or sort a page"""
+    return [
+        detail for detail in plan
+        if (re.fullmatch(r'SCAN \S+', detail) or detail.startswith('USE TEMP B-TREE FOR ORDER BY'))
+        and not detail.startswith(tuple(allowed))
+    ]
+
+def ticket_query_plans():
+    """EXPLAIN QUERY PLAN each ticket query shape (SQLite only)
+
+    Returns [(name, statement, plan, problems)] with one entry per statement a
+    shape runs; problems lists the full scans and sorts from plan_problems().
+    """
+    results = []
+    for name, run, allowed in _ticket_query_shapes():
+        statements = []
+        
+        def capture(conn, cursor, statement, parameters, context, executemany):
+            if statement.lstrip().upper().startswith('SELECT'):
+                statements.append((statement, parameters))
+        
+        db.event.listen(db.engine, 'before_cursor_execute', capture)
+        try:
+            run()
+        finally:
+            db.event.remove(db.engine, 'before_cursor_execute', capture)
+        
+        connection = db.session.connection()
+        for statement, parameters in statements:
+            rows = connection.exec_driver_sql(f'EXPLAIN QUERY PLAN {statement}', parameters)
+            plan = [row[3] for row in rows]
+            results.append((name, statement, plan, plan_problems(plan, allowed)))
+    db.session.rollback()
+    return results
+
+# CLI commands
+@app.cli.command('run-worker')
+@click.option('--threads', type=int, default=None, help='Worker threads (default: JOB_WORKER_THREADS).')
+@click.option('--once', is_flag=True, help='Run every runnable job, then exit.')
+def run_worker_command(threads, once):
+    """Process background jobs until interrupted."""
+    init_db()
+    if once:
+        click.echo(f'Processed {run_pending_jobs()} job(s)')
+        return
+    
+    worker = JobWorker(app, threads=threads).start()
+    stopping = threading.Event()
+    
+    def request_stop(signum, frame):
+        click.echo('Shutting down after running jobs finish...')
+        stopping.set()
+    
+    signal.signal(signal.SIGINT, request_stop)
+    signal.signal(signal.SIGTERM, request_stop)
+    click.echo(f'Job worker running with {worker.threads} thread(s)')
+    stopping.wait()
+    worker.stop()
+
+@app.cli.command('prune-notifications')
+@click.option('--retention-days', type=int, default=None, help='Delete read notifications older than this (default: NOTIFICATION_RETENTION_DAYS, 0 disables).')
+@click.option('--archive-days', type=int, default=None, help='Archive notifications older than this (default: NOTIFICATION_ARCHIVE_DAYS, 0 disables).')
+@click.option('--batch-size', type=int, default=None, help='Rows per transaction (default: NOTIFICATION_PRUNE_BATCH).')
+def prune_notifications_command(retention_days, archive_days, batch_size):
+    """Archive and delete old notifications in small batches."""
+    init_db()
+    stats = prune_notifications(retention_days, archive_days, batch_size)
+    click.echo(
+        f"Archived {stats['archived']} notification(s) and {stats['broadcasts_archived']} broadcast(s), "
+        f"deleted {stats['deleted']} read notification(s) in {stats['seconds']:.2f}s"
+    )
+
+@app.cli.command('repair-notification-counters')
+@click.option('--batch-size', type=int, default=500, show_default=True, help='Users per transaction.')
+def repair_notification_counters_command(batch_size):
+    """Recompute every user's unread notification counter."""
+    init_db()
+    users, fixed = repair_unread_counts(batch_size)
+    click.echo(f'Checked {users} user(s), fixed {fixed} counter(s)')
+
+@app.cli.command('check-query-plans')
+@click.option('--verbose', is_flag=True, help='Print every plan, not just problems.')
+def check_query_plans_command(verbose):
+    """Fail if a ticket query falls back to a full table scan."""
+    init_db()
+    if db.engine.dialect.name != 'sqlite':
+        raise click.ClickException('Query plan checks need SQLite')
+    failed = 0
+    for name, statement, plan, problems in ticket_query_plans():
+        if problems:
+            failed += 1
+        if problems or verbose:
+            click.echo(f"{'FAIL' if problems else 'ok'}  {name}\n{statement}")
+            for detail in plan:
+                click.echo(f"    {'!' if detail in problems else ' '} {detail}")
+    if failed:
+        raise click.ClickException(f'{failed} query plan(s) read a whole table or sort a page')
+    click.echo('All ticket query plans use indexes')
+
+@app.cli.command('repair-queue-counts')
+def repair_queue_counts_command():
+    """Recount every work queue from the tickets."""
+    init_db()
+    rebuild_queue_counts()
+    db.session.commit()
+    click.echo(f'Recounted {QueueCount.query.count()} work queue(s)')
+
 if __name__ == '__main__':
     with app.app_context():
-        db.create_all()
-        
-        # Create default categories if none exist
-        if not Category.query.first():
-            default_categories = [
-                Category(name='Technical Support', description='Technical issues and problems'),
-                Category(name='General Inquiry', description='General questions and information'),
-                Category(name='Bug Report', description='Software bugs and issues'),
-                Category(name='Feature Request', description='New feature suggestions'),
-                Category(name='Account Issues', description='Account-related problems')
-            ]
-            for category in default_categories:
-                db.session.add(category)
-            db.session.commit()
-        
-        # Create admin user if none exists
-        if not User.query.filter_by(role='admin').first():
-            admin = User(
-                username='admin',
-                email='admin@quickdesk.com',
-                password_hash=generate_password_hash('admin123'),
-                role='admin'
-            )
-            db.session.add(admin)
-            db.session.commit()
+        init_db()
+    
+    # The debug reloader re-runs this script; only the child process serves requests
+    if os.environ.get('WERKZEUG_RUN_MAIN') == 'true':
+        worker = JobWorker(app).start()
+        atexit.register(worker.stop, timeout=10)
     
     app.run(debug=True) 
\ No newline at end of file
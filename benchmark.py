@@ -0,0 +1,87 @@
+#!/usr/bin/env python3
+"""
+QuickDesk Benchmark Script
+Measures how request latency scales with the number of staff accounts.
+"""
+
+import os
+import sys
+import tempfile
+import time
+
+# Benchmark against a scratch database, never the real one
+_db_fd, _db_path = tempfile.mkstemp(suffix='.db')
+os.close(_db_fd)
+os.environ['DATABASE_URL'] = f'sqlite:///{_db_path}'
+
+from werkzeug.security import generate_password_hash
+
+from app import app, db, User, Category
+
+PASSWORD = 'bench123'
+AGENT_COUNTS = [10, 100, 300, 1000]
+TICKETS_PER_RUN = 20
+
+
+def reset_database(agent_count):
+    """Recreate the schema with one customer, one admin and agent_count agents"""
+    db.drop_all()
+    db.create_all()
+    password_hash = generate_password_hash(PASSWORD)
+    db.session.add(Category(name='Technical Support', description='Technical issues and problems'))
+    db.session.add(User(username='customer', email='customer@example.com', password_hash=password_hash))
+    db.session.add(User(username='admin', email='admin@example.com', password_hash=password_hash, role='admin'))
+    db.session.execute(db.insert(User), [
+        {
+            'username': f'agent{i}',
+            'email': f'agent{i}@example.com',
+            'password_hash': password_hash,
+            'role': 'agent',
+        }
+        for i in range(agent_count)
+    ])
+    db.session.commit()
+    return Category.query.first().id
+
+
+def benchmark_ticket_creation(agent_count):
+    """Return the mean latency in milliseconds of POST /ticket/new"""
+    with app.app_context():
+        category_id = reset_database(agent_count)
+
+    client = app.test_client()
+    client.post('/login', data={'username': 'customer', 'password': PASSWORD})
+
+    start = time.perf_counter()
+    for i in range(TICKETS_PER_RUN):
+        response = client.post('/ticket/new', data={
+            'subject': f'Benchmark ticket {i}',
+            'description': 'Created by benchmark.py',
+            'category_id': category_id,
+            'priority': 'medium',
+            # The subjects are alike, so skip the duplicate check
+            'confirm_duplicate': '1',
+        })
+        assert response.status_code == 302, response.status_code
+    return (time.perf_counter() - start) * 1000 / TICKETS_PER_RUN
+
+
+def main():
+    """Main benchmark function"""
+    print("🚀 QuickDesk Benchmark")
+    print("=" * 50)
+    print(f"\n🔍 Ticket creation latency ({TICKETS_PER_RUN} tickets per run)...")
+
+    try:
+        for agent_count in AGENT_COUNTS:
+            latency = benchmark_ticket_creation(agent_count)
+            print(f"   - {agent_count:>5} agents: {latency:8.2f} ms/ticket")
+    finally:
+        os.remove(_db_path)
+
+    print("\n" + "=" * 50)
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -16,6 +16,41 @@ class Config:
     MAIL_USE_TLS = os.getenv('MAIL_USE_TLS', 'True').lower() == 'true'
     MAIL_USERNAME = os.getenv('MAIL_USERNAME')
     MAIL_PASSWORD = os.getenv('MAIL_PASSWORD')
+    MAIL_ENABLED = os.getenv('MAIL_ENABLED', 'False').lower() == 'true'
+    MAIL_DEFAULT_SENDER = os.getenv('MAIL_DEFAULT_SENDER', 'QuickDesk <noreply@quickdesk.com>')
+    MAIL_POOL_SIZE = int(os.getenv('MAIL_POOL_SIZE', 2))
+    MAIL_MESSAGES_PER_CONNECTION = int(os.getenv('MAIL_MESSAGES_PER_CONNECTION', 100))
+    MAIL_RATE_LIMIT = float(os.getenv('MAIL_RATE_LIMIT', 10))
+    MAIL_BATCH_SIZE = int(os.getenv('MAIL_BATCH_SIZE', 100))
+    MAIL_TIMEOUT = int(os.getenv('MAIL_TIMEOUT', 30))
+    
+    # Background jobs
+    JOB_WORKER_THREADS = int(os.getenv('JOB_WORKER_THREADS', 2))
+    JOB_MAX_ATTEMPTS = int(os.getenv('JOB_MAX_ATTEMPTS', 5))
+    JOB_RETRY_DELAY = int(os.getenv('JOB_RETRY_DELAY', 5))
+    JOB_LEASE_SECONDS = int(os.getenv('JOB_LEASE_SECONDS', 300))
+    JOB_POLL_INTERVAL = float(os.getenv('JOB_POLL_INTERVAL', 1.0))
+    
+    # Notification stream
+    NOTIFICATION_STREAM_KEEPALIVE = int(os.getenv('NOTIFICATION_STREAM_KEEPALIVE', 25))
+    NOTIFICATION_LONG_POLL_MAX = int(os.getenv('NOTIFICATION_LONG_POLL_MAX', 30))
+    
+    # Notification retention (0 disables a rule)
+    NOTIFICATION_RETENTION_DAYS = int(os.getenv('NOTIFICATION_RETENTION_DAYS', 90))
+    NOTIFICATION_ARCHIVE_DAYS = int(os.getenv('NOTIFICATION_ARCHIVE_DAYS', 365))
+    NOTIFICATION_PRUNE_BATCH = int(os.getenv('NOTIFICATION_PRUNE_BATCH', 500))
+    NOTIFICATION_PRUNE_PAUSE = float(os.getenv('NOTIFICATION_PRUNE_PAUSE', 0.05))
+    NOTIFICATION_AUTO_READ_ON_VIEW = os.getenv('NOTIFICATION_AUTO_READ_ON_VIEW', 'False').lower() == 'true'
+    
+    # Dashboard summary counts cache, in seconds
+    TICKET_STATS_TTL = int(os.getenv('TICKET_STATS_TTL', 30))
+    
+    # Similarity (0-1) at which a new ticket is flagged as a likely duplicate
+    TICKET_DUPLICATE_THRESHOLD = float(os.getenv('TICKET_DUPLICATE_THRESHOLD', 0.5))
+    
+    # Dashboard page cache lifetime, in seconds, and size, in pages
+    TICKET_PAGE_CACHE_TTL = int(os.getenv('TICKET_PAGE_CACHE_TTL', 60))
+    TICKET_PAGE_CACHE_SIZE = int(os.getenv('TICKET_PAGE_CACHE_SIZE', 1000))
 
 class DevelopmentConfig(Config):
     DEBUG = True
@@ -0,0 +1,93 @@
+import os
+import tempfile
+from contextlib import contextmanager
+
+import pytest
+
+# Point the app at a throwaway database before it is imported
+_db_fd, _db_path = tempfile.mkstemp(suffix='.db')
+os.close(_db_fd)
+os.environ['DATABASE_URL'] = f'sqlite:///{_db_path}'
+
+from werkzeug.security import generate_password_hash
+
+from app import app as flask_app, db, User, Category, Ticket
+
+TEST_PASSWORD = 'secret123'
+# Hashing is slow, so every test user shares one precomputed hash
+TEST_PASSWORD_HASH = generate_password_hash(TEST_PASSWORD)
+
+
+@pytest.fixture
+def app():
+    flask_app.config['TESTING'] = True
+    with flask_app.app_context():
+        db.drop_all()
+        db.create_all()
+        yield flask_app
+        db.session.remove()
+
+
+@pytest.fixture
+def client(app):
+    return app.test_client()
+
+
+@pytest.fixture
+def category(app):
+    category = Category(name='Technical Support', description='Technical issues and problems')
+    db.session.add(category)
+    db.session.commit()
+    return category
+
+
+def make_user(username, role='user'):
+    """Create and commit a user with the shared test password"""
+    user = User(
+        username=username,
+        email=f'{username}@example.com',
+        password_hash=TEST_PASSWORD_HASH,
+        role=role
+    )
+    db.session.add(user)
+    db.session.commit()
+    return user
+
+
+def login(client, user):
+    """Log the test client in as user"""
+    return client.post('/login', data={'username': user.username, 'password': TEST_PASSWORD})
+
+
+@contextmanager
+def capture_statements():
+    """Record the SQL statements executed inside the block"""
+    statements = []
+
+    def before_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+        statements.append(statement)
+
+    db.event.listen(db.engine, 'before_cursor_execute', before_cursor_execute)
+    try:
+        yield statements
+    finally:
+        db.event.remove(db.engine, 'before_cursor_execute', before_cursor_execute)
+
+
+def make_ticket(author, category, priority='medium', subject='Printer on fire'):
+    """Create and commit a ticket"""
+    ticket = Ticket(
+        subject=subject,
+        description='It is really on fire',
+        category_id=category.id,
+        priority=priority,
+        user_id=author.id
+    )
+    db.session.add(ticket)
+    db.session.commit()
+    return ticket
+
+
+def pytest_sessionfinish(session, exitstatus):
+    if os.path.exists(_db_path):
+        os.remove(_db_path)
@@ -0,0 +1,306 @@
+import re
+
+from app import (
+    db, Ticket, Comment, Attachment, Category, QueueCount, ticket_stats, create_notifications, notification_row,
+    create_broadcast, backfill_priority_ranks, queue_counts, rebuild_queue_counts
+)
+from conftest import make_user, make_ticket, login, capture_statements
+
+
+def render_dashboard(client):
+    with capture_statements() as statements:
+        response = client.get('/dashboard')
+    assert response.status_code == 200
+    return response, statements
+
+
+def test_recent_notifications_cost_is_independent_of_history(client, category):
+    """The dashboard reads the latest five notifications in a fixed number of queries"""
+    author = make_user('customer')
+    agent = make_user('agent', 'agent')
+    ticket = make_ticket(author, category)
+    login(client, agent)
+
+    def add_history(count):
+        create_notifications(
+            notification_row(agent.id, ticket.id, 'ticket_assigned') for i in range(count)
+        )
+        for i in range(count):
+            create_broadcast('staff', ticket.id, 'ticket_created')
+        db.session.commit()
+
+    render_dashboard(client)  # warm the ticket stats cache
+    add_history(3)
+    _, small = render_dashboard(client)
+    add_history(300)
+    response, large = render_dashboard(client)
+
+    assert len(large) == len(small)
+    notification_queries = [s for s in large if 'FROM notification ' in s or 'FROM broadcast_notification ' in s]
+    assert len(notification_queries) == 2
+    assert all('LIMIT' in s for s in notification_queries)
+    # Tickets come from the same query, not one lazy load per notification
+    assert all('JOIN ticket' in s for s in notification_queries)
+    assert response.data.count(b'onclick="markAsRead(') == 5
+
+
+# Queries per dashboard page: the user, the page cache version and the ticket
+# page, categories, the stats version check and GROUP BY (when the cache is
+# cold), staff work queue counts, and direct notifications, state and
+# broadcasts for the sidebar
+DASHBOARD_QUERY_BUDGET = 10
+
+
+def test_ticket_page_fits_a_fixed_query_budget(client, category):
+    """Author, category and counts come with the tickets, not one lazy load per row"""
+    agent = make_user('agent', 'agent')
+    login(client, agent)
+    render_dashboard(client)  # seed the notification state row
+
+    for i in range(12):
+        author = make_user(f'customer{i}')
+        ticket = make_ticket(author, category, subject=f'Ticket {i}')
+        db.session.add_all([
+            Comment(content='Any update?', user_id=author.id, ticket_id=ticket.id),
+            Comment(content='Still broken', user_id=author.id, ticket_id=ticket.id),
+            Attachment(filename=f'{i}.png', original_filename='screen.png', file_path=f'uploads/{i}.png', ticket_id=ticket.id),
+        ])
+    db.session.commit()
+
+    response, statements = render_dashboard(client)
+    assert len(statements) <= DASHBOARD_QUERY_BUDGET, '\n\n'.join(statements)
+    assert b'customer11' in response.data
+    assert response.data.count(b'fa-comments me-1"></i>2') == 10
+    assert response.data.count(b'fa-paperclip me-1"></i>1') == 10
+
+
+def walk_pages(client, **params):
+    """Follow next cursors from the first page; returns ticket ids per page and the last response"""
+    pages, cursor = [], None
+    while True:
+        response = client.get('/dashboard', query_string=dict(params, cursor=cursor) if cursor else params)
+        pages.append([int(ticket_id) for ticket_id in re.findall(rb'#(\d+) - ', response.data)])
+        match = re.search(rb'href="[^"]*cursor=([^"&]+)[^"]*">\s*<i class="fas fa-chevron-right"', response.data)
+        if match is None:
+            return pages, response
+        cursor = match.group(1).decode()
+
+
+def test_ticket_pages_are_keyset_seeks_in_both_directions(client, category):
+    """Cursor pages visit every ticket once, without OFFSET or a total count"""
+    author = make_user('customer')
+    agent = make_user('agent', 'agent')
+    priorities = ['low', 'medium', 'high', 'urgent']
+    for i in range(25):
+        make_ticket(author, category, priority=priorities[i % 4], subject=f'Ticket {i}')
+    login(client, agent)
+
+    pages, _ = walk_pages(client)
+    expected = [t.id for t in Ticket.query.order_by(Ticket.updated_at.desc(), Ticket.id.desc())]
+    assert [len(page) for page in pages] == [10, 10, 5]
+    assert sum(pages, []) == expected
+
+    pages, last = walk_pages(client, sort='priority')
+    rank = {priority: i for i, priority in enumerate(priorities)}
+    expected = [t.id for t in sorted(
+        Ticket.query.all(), key=lambda t: (rank[t.priority], t.updated_at, t.id), reverse=True
+    )]
+    assert sum(pages, []) == expected
+
+    # Step back from the last page
+    previous = re.search(rb'href="([^"]*cursor=[^"]+)">\s*<i class="fas fa-chevron-left"', last.data).group(1)
+    with capture_statements() as statements:
+        response = client.get(previous.decode().replace('&amp;', '&'))
+    assert [int(i) for i in re.findall(rb'#(\d+) - ', response.data)] == pages[1]
+    # No total count query, and SQLite always renders OFFSET (bound to 0), so
+    # check that the page is found by a row-value seek
+    ticket_queries = [s for s in statements if 'FROM ticket' in s]
+    assert len(ticket_queries) == 1
+    assert ') > (' in ticket_queries[0]
+
+    response = client.get('/dashboard', query_string={'count': 1})
+    assert b'25 tickets' in response.data
+
+
+def test_priority_names_are_backfilled_into_ranks(app, category):
+    """Tickets from before priority_rank get ranked in batches without being touched"""
+    author = make_user('customer')
+    tickets = [make_ticket(author, category, subject=f'Ticket {i}') for i in range(5)]
+    names = ['urgent', 'low', 'high', None, 'medium']
+    with db.engine.begin() as connection:
+        connection.exec_driver_sql('ALTER TABLE ticket ADD COLUMN priority VARCHAR(20)')
+        for ticket, name in zip(tickets, names):
+            connection.exec_driver_sql('UPDATE ticket SET priority = ?, priority_rank = 0 WHERE id = ?', (name, ticket.id))
+    before = {t.id: t.updated_at for t in tickets}
+    db.session.expire_all()
+
+    assert backfill_priority_ranks(batch_size=2) == 5
+    assert [t.priority for t in tickets] == ['urgent', 'low', 'high', 'medium', 'medium']
+    assert {t.id: t.updated_at for t in tickets} == before
+    assert backfill_priority_ranks() == 0
+
+
+def test_summary_panels_count_every_visible_ticket(client, category):
+    """Stats cover all tickets, not the current page, and follow ticket writes"""
+    customer = make_user('customer')
+    other = make_user('other')
+    agent = make_user('agent', 'agent')
+    tickets = [make_ticket(customer, category) for _ in range(12)]
+    make_ticket(other, category)
+    tickets[0].status = 'closed'
+    db.session.commit()
+
+    login(client, agent)
+    assert ticket_stats(agent) == {
+        'status': {'open': 12, 'closed': 1},
+        'category': {category.id: 13},
+        'groups': {('open', category.id): 12, ('closed', category.id): 1},
+        'total': 13,
+    }
+    with capture_statements() as statements:
+        ticket_stats(agent)
+    assert not [s for s in statements if 'GROUP BY' in s]
+
+    tickets[1].status = 'resolved'
+    db.session.commit()
+    assert ticket_stats(agent)['status'] == {'open': 11, 'closed': 1, 'resolved': 1}
+    assert ticket_stats(customer)['status'] == {'open': 10, 'closed': 1, 'resolved': 1}
+
+    response, _ = render_dashboard(client)
+    assert re.search(rb'Open</h6>\s*<h4 class="mb-0">11<', response.data)
+
+
+def test_filtered_totals_come_from_the_cached_stats(client, category):
+    """Status and category totals need no COUNT; search totals are counted on request"""
+    author = make_user('customer')
+    agent = make_user('agent', 'agent')
+    tickets = [make_ticket(author, category, subject=f'Printer {i}') for i in range(15)]
+    for ticket in tickets[:4]:
+        ticket.status = 'closed'
+    db.session.commit()
+    login(client, agent)
+    client.get('/dashboard')  # warm the ticket stats cache
+
+    with capture_statements() as statements:
+        response = client.get('/dashboard', query_string={'status': 'open', 'category': category.id})
+    assert b'11 tickets' in response.data
+    assert not [s for s in statements if 'count(*)' in s]
+
+    response = client.get('/dashboard', query_string={'search': 'printer'})
+    assert b'Count tickets' in response.data
+    response = client.get('/dashboard', query_string={'search': 'printer', 'status': 'closed', 'count': 1})
+    assert b'4 tickets' in response.data
+    # An empty count asks for no total, and the link to count replaces it
+    response = client.get('/dashboard', query_string={'search': 'printer', 'count': ''})
+    assert response.status_code == 200
+    assert b'Count tickets' in response.data
+
+
+def test_repeated_refreshes_reuse_the_page_until_a_ticket_changes(client, category):
+    """Unchanged pages reload their tickets by id; writes through the routes invalidate them"""
+    author = make_user('customer')
+    agent = make_user('agent', 'agent')
+    tickets = [make_ticket(author, category, subject=f'Ticket {i}') for i in range(12)]
+    login(client, agent)
+
+    def refresh(**params):
+        with capture_statements() as statements:
+            response = client.get('/dashboard', query_string=dict(params, status='open'))
+        ticket_queries = [s for s in statements if 'FROM ticket' in s and 'GROUP BY' not in s]
+        return [int(i) for i in re.findall(rb'#(\d+) - ', response.data)], ticket_queries
+
+    first, queries = refresh()
+    assert ' IN (' not in queries[0]
+    again, queries = refresh()
+    assert again == first
+    assert [' IN (' in s for s in queries] == [True]
+    assert 'ORDER BY' not in queries[0]
+
+    # A comment bumps the ticket to the top of the updated_at order
+    oldest = tickets[0]
+    client.post(f'/ticket/{oldest.id}/comment', data={'content': 'Any news?'})
+    ids, queries = refresh()
+    assert ids[0] == oldest.id
+    assert ' IN (' not in queries[0]
+
+    client.post(f'/ticket/{tickets[1].id}/vote', data={'vote_type': 'upvote'})
+    ids, _ = refresh()
+    assert ids[0] == tickets[1].id
+
+    client.post(f'/ticket/{tickets[1].id}/update_status', data={'status': 'closed'})
+    ids, _ = refresh()
+    assert tickets[1].id not in ids
+
+
+def test_work_queues_and_their_counts_follow_assignment(client, category):
+    """Queue counts move with each assignment, status change and deletion, without COUNT queries"""
+    billing = Category(name='Billing')
+    db.session.add(billing)
+    customer = make_user('customer')
+    agent = make_user('agent', 'agent')
+    other_agent = make_user('other', 'agent')
+    low = make_ticket(customer, category, priority='low', subject='Low')
+    urgent = make_ticket(customer, category, priority='urgent', subject='Urgent')
+    invoice = make_ticket(customer, billing, priority='high', subject='Invoice')
+    login(client, agent)
+
+    def counts():
+        return queue_counts(f'agent:{agent.id}', f'agent:{other_agent.id}', 'unassigned', f'unassigned:{category.id}')
+
+    def listed(**params):
+        response = client.get('/dashboard', query_string=params)
+        return [int(i) for i in re.findall(rb'#(\d+) - ', response.data)], response
+
+    assert counts() == {f'agent:{agent.id}': 0, f'agent:{other_agent.id}': 0, 'unassigned': 3, f'unassigned:{category.id}': 2}
+    ids, response = listed(queue='unassigned')
+    assert ids == [urgent.id, invoice.id, low.id]
+    assert b'3 tickets' in response.data
+
+    client.post(f'/ticket/{urgent.id}/assign', data={'assigned_to': agent.id})
+    client.post(f'/ticket/{low.id}/assign', data={'assigned_to': other_agent.id})
+    assert counts() == {f'agent:{agent.id}': 1, f'agent:{other_agent.id}': 1, 'unassigned': 1, f'unassigned:{category.id}': 0}
+    assert listed(queue='mine')[0] == [urgent.id]
+    assert listed(queue='unassigned', category=billing.id)[0] == [invoice.id]
+
+    # In progress stays in the agent's queue; resolving or unassigning moves it out
+    client.post(f'/ticket/{urgent.id}/update_status', data={'status': 'in_progress'})
+    assert counts()[f'agent:{agent.id}'] == 1
+    client.post(f'/ticket/{urgent.id}/update_status', data={'status': 'resolved'})
+    client.post(f'/ticket/{low.id}/assign', data={'assigned_to': ''})
+    db.session.delete(invoice)
+    db.session.commit()
+    assert counts() == {f'agent:{agent.id}': 0, f'agent:{other_agent.id}': 0, 'unassigned': 1, f'unassigned:{category.id}': 1}
+
+    with capture_statements() as statements:
+        ids, response = listed(queue='unassigned')
+    assert ids == [low.id]
+    assert re.search(rb'Unassigned\s*<span class="badge[^"]*">1<', response.data)
+    # Only the ticket stats GROUP BY, refreshed after the writes above
+    assert not [s for s in statements if 'count(*)' in s and 'GROUP BY' not in s]
+
+    # Writes to a ticket whose attributes expired at commit move it too
+    db.session.expire(low)
+    low.assigned_to = agent.id
+    low.category_id = billing.id
+    db.session.commit()
+    assert counts() == {f'agent:{agent.id}': 1, f'agent:{other_agent.id}': 0, 'unassigned': 0, f'unassigned:{category.id}': 0}
+
+    maintained = {row.queue: row.count for row in QueueCount.query}
+    rebuild_queue_counts()
+    assert {row.queue: row.count for row in QueueCount.query if row.count} == {k: v for k, v in maintained.items() if v}
+
+
+def test_only_staff_assign_tickets_to_staff(client, category):
+    customer = make_user('customer')
+    agent = make_user('agent', 'agent')
+    ticket = make_ticket(customer, category)
+
+    login(client, customer)
+    client.post(f'/ticket/{ticket.id}/assign', data={'assigned_to': agent.id})
+    assert ticket.assigned_to is None
+
+    login(client, agent)
+    client.post(f'/ticket/{ticket.id}/assign', data={'assigned_to': customer.id})
+    assert ticket.assigned_to is None
+    client.post(f'/ticket/{ticket.id}/assign', data={'assigned_to': agent.id})
+    assert ticket.assigned_to == agent.id
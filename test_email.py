@@ -0,0 +1,226 @@
+import socketserver
+import threading
+import time
+from email.parser import BytesParser
+
+import pytest
+
+from app import (
+    app as flask_app, db, Job, OutgoingEmail, RateLimiter,
+    create_notifications, notification_row, create_broadcast, run_pending_jobs, mail_pool, close_mail_pools,
+    queue_emails
+)
+from conftest import make_user, make_ticket
+
+
+class SMTPStandIn(socketserver.ThreadingTCPServer):
+    """Minimal local SMTP server that records what it receives
+
+    reject lists addresses refused with 550; drop_after closes the connection
+    instead of accepting that many-th message, once.
+    """
+    daemon_threads = True
+    allow_reuse_address = True
+
+    def __init__(self):
+        super().__init__(('127.0.0.1', 0), SMTPHandler)
+        self.messages = []
+        self.connections = 0
+        self.reject = set()
+        self.drop_after = None
+
+    @property
+    def port(self):
+        return self.server_address[1]
+
+
+class SMTPHandler(socketserver.StreamRequestHandler):
+    def reply(self, line):
+        self.wfile.write(f'{line}\r\n'.encode())
+
+    def handle(self):
+        server = self.server
+        server.connections += 1
+        recipients = []
+        self.reply('220 localhost ESMTP stand-in')
+        for raw in self.rfile:
+            command = raw.decode().strip()
+            verb = command.split(' ', 1)[0].upper()
+            if verb in ('EHLO', 'HELO'):
+                self.reply('250 localhost')
+            elif verb == 'MAIL':
+                recipients = []
+                self.reply('250 OK')
+            elif verb == 'RCPT':
+                address = command.split(':', 1)[1].strip().strip('<>')
+                if address in server.reject:
+                    self.reply('550 No such user')
+                else:
+                    recipients.append(address)
+                    self.reply('250 OK')
+            elif verb == 'DATA':
+                if server.drop_after is not None and len(server.messages) == server.drop_after:
+                    server.drop_after = None
+                    return
+                self.reply('354 End data with <CR><LF>.<CR><LF>')
+                lines = []
+                for line in self.rfile:
+                    if line == b'.\r\n':
+                        break
+                    lines.append(line)
+                server.messages.append((recipients, b''.join(lines)))
+                self.reply('250 OK')
+            elif verb in ('RSET', 'NOOP'):
+                self.reply('250 OK')
+            elif verb == 'QUIT':
+                self.reply('221 Bye')
+                return
+            else:
+                self.reply('502 Not implemented')
+
+
+@pytest.fixture
+def smtp(app):
+    server = SMTPStandIn()
+    thread = threading.Thread(target=server.serve_forever, kwargs={'poll_interval': 0.05}, daemon=True)
+    thread.start()
+    settings = {
+        'MAIL_ENABLED': True,
+        'MAIL_SERVER': '127.0.0.1',
+        'MAIL_PORT': server.port,
+        'MAIL_USE_TLS': False,
+        'MAIL_RATE_LIMIT': 0,
+        'JOB_RETRY_DELAY': 0,
+    }
+    previous = {key: flask_app.config[key] for key in settings}
+    flask_app.config.update(settings)
+    yield server
+    flask_app.config.update(previous)
+    close_mail_pools()
+    server.shutdown()
+    server.server_close()
+
+
+def make_recipients(count):
+    return [make_user(f'user{i}') for i in range(count)]
+
+
+def test_notification_emails_are_sent_off_the_request_path_over_one_connection(smtp, category):
+    """Emails wait for a worker, then share a pooled connection"""
+    users = make_recipients(50)
+    ticket = make_ticket(users[0], category)
+    create_notifications(notification_row(user.id, ticket.id, 'ticket_assigned') for user in users)
+    db.session.commit()
+
+    assert smtp.messages == []
+    assert Job.query.filter_by(name='send_emails').count() == 1
+
+    run_pending_jobs()
+
+    assert sorted(recipients[0] for recipients, _ in smtp.messages) == sorted(user.email for user in users)
+    assert smtp.connections == 1
+    assert OutgoingEmail.query.filter_by(status='sent').count() == 50
+
+
+def test_connections_are_recycled_after_their_message_quota(smtp, category):
+    flask_app.config['MAIL_MESSAGES_PER_CONNECTION'] = 10
+    try:
+        users = make_recipients(25)
+        ticket = make_ticket(users[0], category)
+        create_notifications(notification_row(user.id, ticket.id, 'ticket_assigned') for user in users)
+        db.session.commit()
+        run_pending_jobs()
+    finally:
+        flask_app.config['MAIL_MESSAGES_PER_CONNECTION'] = 100
+
+    assert len(smtp.messages) == 25
+    assert smtp.connections == 3
+
+
+def test_broadcast_email_batches_recipients_into_one_message(smtp, category):
+    agents = [make_user(f'agent{i}', 'agent') for i in range(3)]
+    customer = make_user('customer')
+    ticket = make_ticket(customer, category)
+    create_broadcast('staff', ticket.id, 'ticket_created')
+    db.session.commit()
+    run_pending_jobs()
+
+    [(recipients, data)] = smtp.messages
+    assert sorted(recipients) == sorted(agent.email for agent in agents)
+    assert b'undisclosed-recipients' in data
+
+
+def test_dropped_connection_retries_only_unsent_emails(smtp, category):
+    """A connection failure retries the job without resending delivered mail"""
+    smtp.drop_after = 3
+    users = make_recipients(6)
+    ticket = make_ticket(users[0], category)
+    create_notifications(notification_row(user.id, ticket.id, 'ticket_assigned') for user in users)
+    db.session.commit()
+    run_pending_jobs()
+
+    assert sorted(recipients[0] for recipients, _ in smtp.messages) == sorted(user.email for user in users)
+    assert smtp.connections == 2
+    assert Job.query.count() == 0
+
+
+def test_rejected_address_fails_without_blocking_the_batch(smtp, category):
+    users = make_recipients(3)
+    smtp.reject.add(users[1].email)
+    ticket = make_ticket(users[0], category)
+    create_notifications(notification_row(user.id, ticket.id, 'ticket_assigned') for user in users)
+    db.session.commit()
+    run_pending_jobs()
+
+    assert len(smtp.messages) == 2
+    failed = OutgoingEmail.query.filter_by(status='failed').one()
+    assert failed.recipients == users[1].email
+    assert '550' in failed.last_error
+    assert Job.query.count() == 0
+
+
+def test_line_breaks_in_a_batch_neither_inject_headers_nor_resend_the_batch(smtp, category):
+    """A message that can't be built fails alone; the rest of its batch is sent once"""
+    users = make_recipients(3)
+    ticket = make_ticket(users[0], category, subject='Printer\r\nBcc: everyone@example.com')
+    create_notifications(notification_row(user.id, ticket.id, 'ticket_assigned') for user in users)
+    queue_emails([
+        {'recipients': ['first@example.com'], 'subject': 'First', 'body': 'Hi'},
+        {'recipients': ['bad@example.com\r\nBcc: everyone@example.com'], 'subject': 'Bad', 'body': 'Hi'},
+        {'recipients': ['last@example.com'], 'subject': 'Last', 'body': 'Hi'},
+    ])
+    db.session.commit()
+    run_pending_jobs()
+
+    sent = sorted(recipients[0] for recipients, _ in smtp.messages)
+    assert sent == sorted([user.email for user in users] + ['first@example.com', 'last@example.com'])
+    for _, data in smtp.messages:
+        headers = BytesParser().parsebytes(data, headersonly=True)
+        assert headers['Bcc'] is None
+    failed = OutgoingEmail.query.filter_by(status='failed').one()
+    assert failed.subject == 'Bad'
+    assert OutgoingEmail.query.filter_by(status='sent').count() == 5
+    assert Job.query.count() == 0
+
+
+def test_rate_limit_is_shared_by_a_servers_connections(smtp):
+    """Sends through every connection to a server draw on one token bucket"""
+    flask_app.config['MAIL_RATE_LIMIT'] = 20
+    try:
+        pool = mail_pool()
+    finally:
+        flask_app.config['MAIL_RATE_LIMIT'] = 0
+    assert isinstance(pool.rate_limiter, RateLimiter)
+
+    def send_burst():
+        for _ in range(15):
+            pool.rate_limiter.acquire()
+
+    started = time.perf_counter()
+    threads = [threading.Thread(target=send_burst) for _ in range(2)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    # 20 messages go out in the first burst and the other 10 at 20 per second
+    assert time.perf_counter() - started >= 0.45
@@ -0,0 +1,752 @@
+import json
+import threading
+import time
+from datetime import datetime, timedelta
+
+from sqlalchemy.exc import OperationalError
+
+import app as app_module
+from app import (
+    app as flask_app, db, Notification, NotificationState, BroadcastNotification, Comment,
+    Job, JobWorker, JOB_HANDLERS, unread_notification_count,
+    job_handler, enqueue_job, claim_job, run_job, run_pending_jobs, repair_unread_counts,
+    fetch_notifications, create_notifications, notification_row, prune_notifications, NotificationArchive,
+    notify_ticket_created, notify_comment_added, create_broadcast, role_member_ids, CacheVersion, User,
+    create_notification, ensure_notification_states, queue_counts, upgrade_schema
+)
+from conftest import make_user, make_ticket, login, capture_statements
+
+
+def test_bulk_notifications_are_one_insert(app, category):
+    """create_notifications writes every recipient with a single INSERT statement"""
+    author = make_user('customer')
+    agents = [make_user(f'agent{i}', 'agent') for i in range(50)]
+    ticket = make_ticket(author, category)
+
+    with capture_statements() as statements:
+        create_notifications(
+            notification_row(agent.id, ticket.id, 'ticket_assigned') for agent in agents
+        )
+        db.session.commit()
+
+    inserts = [s for s in statements if s.startswith('INSERT INTO notification (')]
+    assert len(inserts) == 1
+    assert Notification.query.filter_by(ticket_id=ticket.id).count() == 50
+
+
+def test_ticket_created_is_stored_once_for_all_staff(app, category):
+    """A new ticket is one broadcast row that every admin and agent sees as unread"""
+    author = make_user('customer')
+    staff = [make_user(f'admin{i}', 'admin') for i in range(3)]
+    staff += [make_user(f'agent{i}', 'agent') for i in range(50)]
+    ticket = make_ticket(author, category)
+
+    notify_ticket_created(ticket)
+    run_pending_jobs()
+
+    assert BroadcastNotification.query.count() == 1
+    assert Notification.query.count() == 0
+    assert {unread_notification_count(user) for user in staff} == {1}
+    assert unread_notification_count(author) == 0
+
+
+def test_comment_on_urgent_ticket_notifies_creator_assignee_and_admins(app, category):
+    """Comment fan-out skips the commenter and reaches everyone else"""
+    author = make_user('customer')
+    agent = make_user('agent', 'agent')
+    admin = make_user('admin', 'admin')
+    commenter = make_user('other_admin', 'admin')
+    ticket = make_ticket(author, category, priority='urgent')
+    ticket.assigned_to = agent.id
+    comment = Comment(content='Looking into it', user_id=commenter.id, ticket_id=ticket.id)
+    db.session.add(comment)
+    db.session.commit()
+
+    notify_comment_added(comment)
+    run_pending_jobs()
+
+    recipients = {n.user_id for n in Notification.query.filter_by(comment_id=comment.id)}
+    assert recipients == {author.id, agent.id, admin.id}
+
+
+def test_new_ticket_queues_fan_out_instead_of_running_it(client, category):
+    """Creating a ticket only enqueues the notification fan-out"""
+    author = make_user('customer')
+    make_user('agent', 'agent')
+    login(client, author)
+
+    response = client.post('/ticket/new', data={
+        'subject': 'VPN is down',
+        'description': 'Cannot connect',
+        'category_id': category.id,
+    })
+
+    assert response.status_code == 302
+    assert BroadcastNotification.query.count() == 0
+    assert Job.query.filter_by(name='notify_ticket_created').count() == 1
+
+    assert run_pending_jobs() == 1
+    assert BroadcastNotification.query.count() == 1
+    assert Job.query.count() == 0
+
+
+def test_failed_job_is_retried_with_backoff_then_marked_failed(app):
+    """Failures are rescheduled until max_attempts, then kept as failed"""
+    calls = []
+
+    @job_handler('test_flaky')
+    def flaky():
+        calls.append(1)
+        raise RuntimeError('boom')
+
+    try:
+        job = enqueue_job('test_flaky')
+        job.max_attempts = 2
+        db.session.commit()
+
+        assert run_job(claim_job()) is False
+        db.session.refresh(job)
+        assert job.status == 'queued'
+        assert job.run_at > datetime.utcnow()
+        assert 'boom' in job.last_error
+        assert claim_job() is None  # still backing off
+
+        job.run_at = datetime.utcnow()
+        db.session.commit()
+        assert run_job(claim_job()) is False
+        db.session.refresh(job)
+        assert job.status == 'failed'
+        assert job.attempts == 2
+        assert claim_job() is None
+        assert len(calls) == 2
+    finally:
+        JOB_HANDLERS.pop('test_flaky')
+
+
+def test_expired_lease_is_reclaimed(app):
+    """A job left running by a dead worker is picked up again"""
+    job = enqueue_job('notify_ticket_created', ticket_id=0)
+    assert claim_job() == job.id
+    assert claim_job() is None
+
+    job.locked_until = datetime.utcnow()
+    db.session.commit()
+    assert claim_job() == job.id
+
+
+def test_worker_threads_drain_queue_and_stop(app, category):
+    """A JobWorker processes queued jobs and shuts down cleanly"""
+    author = make_user('customer')
+    make_user('admin', 'admin')
+    ticket = make_ticket(author, category)
+    notify_ticket_created(ticket)
+
+    worker = JobWorker(flask_app, threads=2, poll_interval=0.05).start()
+    try:
+        deadline = time.time() + 5
+        while time.time() < deadline and BroadcastNotification.query.count() == 0:
+            time.sleep(0.05)
+            db.session.expire_all()
+    finally:
+        worker.stop(timeout=5)
+
+    assert BroadcastNotification.query.count() == 1
+    assert not worker._threads
+
+
+def test_worker_thread_survives_a_job_that_fails_to_record_its_failure(app, category, monkeypatch):
+    author = make_user('customer')
+    make_user('admin', 'admin')
+    run = app_module.run_job
+    calls = []
+
+    def locked_then_run(job_id):
+        calls.append(job_id)
+        if len(calls) == 1:
+            raise OperationalError('UPDATE job', {}, Exception('database is locked'))
+        return run(job_id)
+
+    monkeypatch.setattr(app_module, 'run_job', locked_then_run)
+    notify_ticket_created(make_ticket(author, category))
+    worker = JobWorker(flask_app, threads=1, poll_interval=0.05).start()
+    try:
+        deadline = time.time() + 5
+        while time.time() < deadline and len(calls) < 1:
+            time.sleep(0.05)
+        notify_ticket_created(make_ticket(author, category))
+        while time.time() < deadline and BroadcastNotification.query.count() == 0:
+            time.sleep(0.05)
+            db.session.expire_all()
+        assert all(thread.is_alive() for thread in worker._threads)
+    finally:
+        worker.stop(timeout=5)
+
+    assert BroadcastNotification.query.count() == 1
+    # A missing job is skipped rather than crashing the worker
+    assert run(999999) is False
+
+
+def read_event(stream):
+    """Return the next data payload from an SSE response iterator"""
+    for chunk in stream:
+        for line in chunk.decode().splitlines():
+            if line.startswith('data: '):
+                return json.loads(line[len('data: '):])
+
+
+def test_stream_pushes_count_and_new_notifications(client, category):
+    """The SSE stream sends the count up front, then each committed fan-out"""
+    author = make_user('customer')
+    agent = make_user('agent', 'agent')
+    ticket = make_ticket(author, category, subject='Laptop will not boot')
+    login(client, agent)
+
+    response = client.get('/api/notifications/stream', buffered=False)
+    assert response.mimetype == 'text/event-stream'
+    stream = iter(response.response)
+    try:
+        assert read_event(stream) == {'count': 0, 'notifications': []}
+
+        notify_ticket_created(ticket)
+        run_pending_jobs()
+
+        event = read_event(stream)
+        assert event['count'] == 1
+        assert [n['type'] for n in event['notifications']] == ['ticket_created']
+        assert 'Laptop will not boot' in event['notifications'][0]['message']
+    finally:
+        response.close()
+
+
+def notify_directly(user, ticket, times=1):
+    create_notifications(
+        notification_row(user.id, ticket.id, 'ticket_assigned') for i in range(times)
+    )
+    db.session.commit()
+
+
+def test_unread_counter_tracks_fan_out_and_mark_read(client, category):
+    """The counter row follows creates, single marks and mark-all"""
+    author = make_user('customer')
+    ticket = make_ticket(author, category)
+    notify_directly(author, ticket, times=3)
+    assert db.session.get(NotificationState, author.id).unread_count == 3
+
+    login(client, author)
+    assert client.get('/api/notifications/count').get_json() == {'count': 3}
+
+    first = Notification.query.filter_by(user_id=author.id).first()
+    client.post(f'/notifications/mark-read/{first.id}')
+    client.post(f'/notifications/mark-read/{first.id}')
+    assert client.get('/api/notifications/count').get_json() == {'count': 2}
+
+    client.post('/notifications/mark-all-read')
+    assert client.get('/api/notifications/count').get_json() == {'count': 0}
+
+
+def test_counter_is_seeded_for_users_without_one(client, category):
+    """Users with notifications from before counters existed get correct counts"""
+    author = make_user('customer')
+    ticket = make_ticket(author, category)
+    db.session.add(Notification(user_id=author.id, ticket_id=ticket.id, type='status_changed', stored_message='old'))
+    db.session.commit()
+
+    notify_directly(author, ticket)
+    assert db.session.get(NotificationState, author.id).unread_count == 2
+
+
+def test_repair_recomputes_drifted_counters(app, category):
+    """repair_unread_counts fixes wrong counters in batches"""
+    users = [make_user(f'customer{i}') for i in range(5)]
+    agent = make_user('agent', 'agent')
+    ticket = make_ticket(users[0], category)
+    for user in users:
+        notify_directly(user, ticket)
+    db.session.get(NotificationState, users[0].id).unread_count = 42
+    db.session.get(NotificationState, users[3].id).unread_count = -1
+    db.session.commit()
+
+    assert repair_unread_counts(batch_size=2) == (6, 2)
+    assert {db.session.get(NotificationState, user.id).unread_count for user in users} == {1}
+    assert db.session.get(NotificationState, agent.id).unread_count == 0
+
+
+def test_repair_creates_missing_counters_with_old_broadcasts_read(app, category):
+    author = make_user('customer')
+    notify_ticket_created(make_ticket(author, category))
+    run_pending_jobs()
+    BroadcastNotification.query.update({'created_at': datetime(2020, 1, 1)})
+    agent = make_user('agent', 'agent')
+    db.session.commit()
+    assert db.session.get(NotificationState, agent.id) is None
+
+    repair_unread_counts()
+    assert unread_notification_count(agent) == 0
+    assert fetch_notifications(agent)[0] == []
+
+
+def test_inbox_pages_by_cursor_without_gaps_or_count(client, category):
+    """Walking the inbox by cursor visits every notification once, newest first"""
+    author = make_user('customer')
+    reader = make_user('reader')
+    ticket = make_ticket(author, category)
+    # Two batches, so many rows share a created_at and the id tie-break matters
+    for batch in range(2):
+        create_notifications(
+            notification_row(reader.id, ticket.id, 'ticket_assigned') for i in range(23)
+        )
+        db.session.commit()
+
+    reader.id  # refresh the expired user before counting statements
+    seen, cursor = [], None
+    with capture_statements() as statements:
+        while True:
+            page, cursor = fetch_notifications(reader, cursor, limit=10)
+            seen.extend(n.id for n in page)
+            if cursor is None:
+                break
+
+    expected = [n.id for n in Notification.query.order_by(Notification.created_at.desc(), Notification.id.desc())]
+    assert seen == expected
+    assert len(statements) == 5
+    assert not any('count(' in s.lower() for s in statements)
+
+    login(client, reader)
+    first = client.get('/api/notifications?limit=40').get_json()
+    assert len(first['notifications']) == 40
+    rest = client.get(f"/api/notifications?cursor={first['next_cursor']}").get_json()
+    assert [n['id'] for n in first['notifications'] + rest['notifications']] == expected
+    assert rest['next_cursor'] is None
+    assert client.get('/notifications').status_code == 200
+
+
+def test_inbox_page_query_uses_user_index(app):
+    """Inbox pages are an index seek, not a scan and sort"""
+    query = Notification.query.filter(
+        Notification.user_id == 1,
+        db.tuple_(Notification.created_at, Notification.id) < (datetime.utcnow(), 10)
+    ).order_by(Notification.created_at.desc(), Notification.id.desc()).limit(21)
+    sql = str(query.statement.compile(db.engine, compile_kwargs={'literal_binds': True}))
+    plan = ' '.join(row[-1] for row in db.session.execute(db.text(f'EXPLAIN QUERY PLAN {sql}')))
+
+    assert 'ix_notification_user_created' in plan
+    assert 'TEMP B-TREE' not in plan
+
+
+def add_comment(ticket, author, content='Any update?'):
+    comment = Comment(content=content, user_id=author.id, ticket_id=ticket.id)
+    db.session.add(comment)
+    db.session.commit()
+    notify_comment_added(comment)
+    run_pending_jobs()
+    return comment
+
+
+def test_comments_coalesce_into_one_unread_notification(client, category):
+    """Repeated comments update the recipient's unread row instead of adding rows"""
+    author = make_user('customer')
+    agent = make_user('agent', 'agent')
+    ticket = make_ticket(author, category)
+    ticket.assigned_to = agent.id
+    db.session.commit()
+
+    for i in range(5):
+        last = add_comment(ticket, author, f'Update {i}')
+
+    notification = Notification.query.filter_by(user_id=agent.id, type='comment_added').one()
+    assert notification.event_count == 5
+    assert notification.comment_id == last.id
+    assert db.session.get(NotificationState, agent.id).unread_count == 1
+
+    # A row whose text was stored by an older version is re-rendered once it coalesces
+    notification.stored_message = 'New comment on your ticket by someone else'
+    db.session.commit()
+    add_comment(ticket, author)
+    db.session.refresh(notification)
+    assert notification.event_count == 6
+    assert notification.message == f'New comment on assigned ticket "{ticket.subject}" by {author.username}'
+
+    # Once read, the next comment starts a fresh notification
+    login(client, agent)
+    client.post(f'/notifications/mark-read/{notification.id}')
+    add_comment(ticket, author)
+    assert Notification.query.filter_by(user_id=agent.id, type='comment_added').count() == 2
+    assert db.session.get(NotificationState, agent.id).unread_count == 1
+
+
+def test_coalescing_survives_writers_racing_past_the_lookup(app, category, monkeypatch):
+    """A row read or added by someone else after the lookup still ends with one unread row"""
+    author = make_user('customer')
+    agent = make_user('agent', 'agent')
+    ticket = make_ticket(author, category)
+
+    def comment():
+        create_notifications([notification_row(agent.id, ticket.id, 'comment_added', author.id)])
+        db.session.commit()
+
+    def unread():
+        return Notification.query.filter_by(user_id=agent.id, is_read=False).all()
+
+    # Another writer adds the unread row after the lookup found none
+    lookup = app_module.coalesce_notifications
+
+    def racing_insert(rows, now):
+        result = lookup(rows, now)
+        db.session.execute(db.insert(Notification), [dict(rows[0], event_count=1)])
+        return result
+
+    monkeypatch.setattr(app_module, 'coalesce_notifications', racing_insert)
+    comment()
+    [notification] = unread()
+    assert notification.event_count == 2
+    monkeypatch.undo()
+
+    # The user reads the row the lookup found before it is updated
+    fold = app_module._fold_notification
+
+    def read_first(row, now, notification_id=None):
+        if notification_id is not None:
+            db.session.execute(db.update(Notification).where(Notification.id == notification_id).values(is_read=True))
+        return fold(row, now, notification_id)
+
+    monkeypatch.setattr(app_module, '_fold_notification', read_first)
+    comment()
+    [fresh] = unread()
+    assert fresh.id != notification.id
+    assert fresh.event_count == 1
+
+
+def test_upgrade_merges_duplicate_unread_notifications(app, category):
+    author = make_user('customer')
+    agent = make_user('agent', 'agent')
+    ticket = make_ticket(author, category)
+    with db.engine.begin() as connection:
+        connection.execute(db.text('DROP INDEX ux_notification_unread_coalesce'))
+    for _ in range(3):
+        db.session.execute(db.insert(Notification), [
+            dict(notification_row(agent.id, ticket.id, 'comment_added', author.id), is_read=False, event_count=2)
+        ])
+    ensure_notification_states([agent.id])
+    repair_unread_counts()
+
+    upgrade_schema()
+    [notification] = Notification.query.filter_by(user_id=agent.id).all()
+    assert notification.event_count == 6
+    assert unread_notification_count(agent) == 1
+    indexes = {index['name'] for index in db.inspect(db.engine).get_indexes('notification')}
+    assert 'ux_notification_unread_coalesce' in indexes
+
+
+def test_broadcasts_merge_into_inbox_and_read_by_watermark(client, category):
+    """Broadcasts page together with direct notifications and are read up to a watermark"""
+    author = make_user('customer')
+    agent = make_user('agent', 'agent')
+    tickets = [make_ticket(author, category, subject=f'Ticket {i}') for i in range(15)]
+    for ticket in tickets:
+        notify_ticket_created(ticket)
+        run_pending_jobs()
+        notify_directly(agent, ticket)
+
+    seen, cursor = [], None
+    while True:
+        page, cursor = fetch_notifications(agent, cursor, limit=7)
+        seen.extend((n.kind, n.id) for n in page)
+        if cursor is None:
+            break
+    assert len(seen) == len(set(seen)) == 30
+    assert [kind for kind, _ in seen[:2]] == ['direct', 'broadcast']
+    assert unread_notification_count(agent) == 30
+
+    # Customers never see staff broadcasts
+    assert [n.kind for n in fetch_notifications(author)[0]] == []
+
+    login(client, agent)
+    fifth = BroadcastNotification.query.order_by(BroadcastNotification.id).all()[4]
+    assert client.post(f'/notifications/broadcast/mark-read/{fifth.id}').get_json() == {'success': True}
+    assert client.get('/api/notifications/count').get_json() == {'count': 25}
+
+    client.post('/notifications/mark-all-read')
+    assert client.get('/api/notifications/count').get_json() == {'count': 0}
+    assert all(n.is_read for n in fetch_notifications(agent, limit=50)[0])
+
+
+def test_counter_rows_are_created_on_databases_without_insert_ignore(client, category, monkeypatch):
+    """Other databases insert missing keys one at a time instead of failing the write"""
+    author = make_user('customer')
+    agent = make_user('agent', 'agent')
+    ticket = make_ticket(author, category)
+    monkeypatch.setattr(db.engine.dialect, 'name', 'oracle')
+    login(client, agent)
+
+    with capture_statements() as statements:
+        client.post(f'/ticket/{ticket.id}/assign', data={'assigned_to': agent.id})
+    assert any(s.startswith('SAVEPOINT') for s in statements)
+    notify_directly(author, ticket, times=2)
+    notify_directly(author, ticket)
+    assert db.session.get(NotificationState, author.id).unread_count == 3
+    assert queue_counts(f'agent:{agent.id}') == {f'agent:{agent.id}': 1}
+    assert CacheVersion.query.filter_by(name='ticket_list').count() == 1
+
+
+def test_new_staff_do_not_inherit_old_broadcasts(app, category):
+    """Broadcasts from before a user joined are neither listed nor unread"""
+    author = make_user('customer')
+    notify_ticket_created(make_ticket(author, category))
+    run_pending_jobs()
+    BroadcastNotification.query.update({'created_at': datetime(2020, 1, 1)})
+    db.session.commit()
+
+    agents = [make_user(f'agent{i}', 'agent') for i in range(3)]
+    agent = agents[0]
+    with capture_statements() as statements:
+        ensure_notification_states(user.id for user in agents)
+    assert len([s for s in statements if 'max(broadcast_notification.id)' in s]) == 1
+    assert unread_notification_count(agent) == 0
+    assert fetch_notifications(agent)[0] == []
+
+    notify_ticket_created(make_ticket(author, category))
+    run_pending_jobs()
+    assert unread_notification_count(agent) == 1
+
+
+def test_prune_archives_old_and_deletes_read_notifications(app, category):
+    """Retention runs in batches, keeps recent rows and fixes unread counters"""
+    author = make_user('customer')
+    agent = make_user('agent', 'agent')
+    ticket = make_ticket(author, category)
+    notify_directly(author, ticket, times=12)
+    notify_ticket_created(ticket)
+    run_pending_jobs()
+
+    now = datetime.utcnow()
+    rows = Notification.query.order_by(Notification.id).all()
+    for row in rows[:4]:      # ancient: archived whether read or not
+        row.created_at = now - timedelta(days=400)
+    for row in rows[4:6]:
+        row.is_read = True
+    for row in rows[4:10]:    # old: deleted only if read
+        row.created_at = now - timedelta(days=100)
+    rows[0].is_read = True
+    BroadcastNotification.query.update({'created_at': now - timedelta(days=400)})
+    NotificationState.query.filter_by(user_id=author.id).update({'unread_count': 9})
+    db.session.commit()
+
+    stats = prune_notifications(retention_days=90, archive_days=365, batch_size=3, pause=0)
+
+    assert (stats['archived'], stats['broadcasts_archived'], stats['deleted']) == (4, 1, 2)
+    assert stats['seconds'] >= 0
+    assert Notification.query.count() == 6
+    assert NotificationArchive.query.count() == 5
+    assert BroadcastNotification.query.count() == 0
+    assert unread_notification_count(author) == 6
+    assert unread_notification_count(agent) == 0
+
+
+def test_batch_mark_read_is_one_owner_scoped_update(client, category):
+    """The batch endpoint marks ids and watermarks with one UPDATE per kind"""
+    author = make_user('customer')
+    other = make_user('other')
+    ticket = make_ticket(author, category)
+    notify_directly(author, ticket, times=6)
+    notify_directly(other, ticket)
+    ids = [n.id for n in Notification.query.filter_by(user_id=author.id).order_by(Notification.id)]
+    foreign_id = Notification.query.filter_by(user_id=other.id).one().id
+    login(client, author)
+
+    with capture_statements() as statements:
+        response = client.post('/api/notifications/mark-read', json={'ids': ids[:2] + [foreign_id]})
+    assert response.get_json() == {'success': True, 'marked': 2, 'count': 4}
+    assert len([s for s in statements if s.startswith('UPDATE notification SET')]) == 1
+    assert unread_notification_count(other) == 1
+
+    positions = {n['id']: n['position'] for n in client.get('/api/notifications').get_json()['notifications']}
+    response = client.post('/api/notifications/mark-read', json={'up_to': positions[ids[4]]})
+    assert response.get_json() == {'success': True, 'marked': 3, 'count': 1}
+    assert client.post('/api/notifications/mark-read', json={'ids': ['x']}).status_code == 400
+    # A string is not a list of ids, even when it is made of digits
+    assert client.post('/api/notifications/mark-read', json={'ids': '123'}).status_code == 400
+    assert client.post('/api/notifications/mark-read', json={'broadcast_up_to_id': 2 ** 70}).status_code == 400
+    assert client.post('/api/notifications/mark-read', json={'up_to': 'x'}).status_code == 400
+
+
+def test_batch_mark_read_up_to_leaves_events_coalesced_since_unread(client, category):
+    """A coalesced notification that took a new event after the client rendered it stays unread"""
+    author = make_user('customer')
+    agent = make_user('agent', 'agent')
+    ticket = make_ticket(author, category)
+    ticket.assigned_to = agent.id
+    db.session.commit()
+    add_comment(ticket, author)
+    notify_directly(agent, ticket)
+    login(client, agent)
+    [newest, commented] = client.get('/api/notifications').get_json()['notifications']
+    assert commented['type'] == 'comment_added'
+
+    add_comment(ticket, author)
+    response = client.post('/api/notifications/mark-read', json={'up_to': newest['position']})
+    assert response.get_json() == {'success': True, 'marked': 1, 'count': 1}
+    notification = db.session.get(Notification, commented['id'])
+    assert (notification.is_read, notification.event_count) == (False, 2)
+
+
+def test_batch_broadcast_watermark_stops_at_the_newest_broadcast(client, category):
+    """Marking broadcasts read up to a future id leaves later broadcasts unread"""
+    author = make_user('customer')
+    agent = make_user('agent', 'agent')
+    notify_ticket_created(make_ticket(author, category))
+    run_pending_jobs()
+    login(client, agent)
+
+    response = client.post('/api/notifications/mark-read', json={'broadcast_up_to_id': 999999999})
+    assert response.get_json()['count'] == 0
+    notify_ticket_created(make_ticket(author, category))
+    run_pending_jobs()
+    assert unread_notification_count(agent) == 1
+
+
+def test_viewing_ticket_marks_its_notifications_read_when_enabled(client, category):
+    """NOTIFICATION_AUTO_READ_ON_VIEW marks the viewed ticket's notifications read"""
+    author = make_user('customer')
+    seen, unseen = make_ticket(author, category), make_ticket(author, category)
+    notify_directly(author, seen, times=2)
+    notify_directly(author, unseen)
+    login(client, author)
+
+    client.get(f'/ticket/{seen.id}')
+    assert unread_notification_count(author) == 3
+
+    flask_app.config['NOTIFICATION_AUTO_READ_ON_VIEW'] = True
+    try:
+        client.get(f'/ticket/{seen.id}')
+    finally:
+        flask_app.config['NOTIFICATION_AUTO_READ_ON_VIEW'] = False
+    assert unread_notification_count(author) == 1
+    assert Notification.query.filter_by(ticket_id=unseen.id, is_read=False).count() == 1
+
+
+def test_unchanged_count_is_a_304_without_reading_notifications(client, category):
+    """The count ETag comes from the counter version and the range of broadcast ids"""
+    agent = make_user('agent', 'agent')
+    ticket = make_ticket(agent, category)
+    notify_directly(agent, ticket)
+    login(client, agent)
+
+    response = client.get('/api/notifications/count')
+    assert response.get_json() == {'count': 1}
+    etag = response.headers['ETag']
+
+    with capture_statements() as statements:
+        response = client.get('/api/notifications/count', headers={'If-None-Match': etag})
+    assert response.status_code == 304
+    assert not [s for s in statements if 'FROM notification ' in s or 'count(' in s]
+
+    def next_etag():
+        response = client.get('/api/notifications/count', headers={'If-None-Match': etag})
+        assert response.status_code == 200
+        return response.headers['ETag'], response.get_json()['count']
+
+    notify_directly(agent, ticket)
+    etag, count = next_etag()
+    assert count == 2
+    create_broadcast('staff', ticket.id, 'ticket_created')
+    db.session.commit()
+    etag, count = next_etag()
+    assert count == 3
+    create_broadcast('staff', ticket.id, 'ticket_created')
+    db.session.commit()
+    etag, count = next_etag()
+    assert count == 4
+
+    # Archiving an old unread broadcast lowers the count without touching the counter row
+    oldest = BroadcastNotification.query.order_by(BroadcastNotification.id).first()
+    oldest.created_at = datetime.utcnow() - timedelta(days=400)
+    db.session.commit()
+    prune_notifications(retention_days=0, archive_days=365, pause=0)
+    etag, count = next_etag()
+    assert count == 3
+
+    client.post('/notifications/mark-all-read')
+    etag, count = next_etag()
+    assert count == 0
+
+
+def test_long_poll_returns_when_the_count_changes(client, category):
+    """?wait= holds a matching request until a change is committed or it times out"""
+    user = make_user('customer')
+    ticket = make_ticket(user, category)
+    user_id, ticket_id = user.id, ticket.id
+    login(client, user)
+    etag = client.get('/api/notifications/count').headers['ETag']
+
+    started = time.perf_counter()
+    response = client.get('/api/notifications/count?wait=0.2', headers={'If-None-Match': etag})
+    assert response.status_code == 304
+    assert time.perf_counter() - started >= 0.2
+
+    def notify_later():
+        time.sleep(0.2)
+        with flask_app.app_context():
+            create_notifications([notification_row(user_id, ticket_id, 'ticket_assigned')])
+            db.session.commit()
+            db.session.remove()
+
+    thread = threading.Thread(target=notify_later)
+    thread.start()
+    started = time.perf_counter()
+    response = client.get('/api/notifications/count?wait=10', headers={'If-None-Match': etag})
+    thread.join()
+    assert response.get_json() == {'count': 1}
+    assert time.perf_counter() - started < 5
+
+
+def test_role_members_are_cached_until_membership_changes(client, category):
+    """Admin user changes invalidate the cached role lookups, even from another session"""
+    admin = make_user('admin', 'admin')
+    agent = make_user('agent', 'agent')
+    assert role_member_ids('admin') == [admin.id]
+    with capture_statements() as statements:
+        assert role_member_ids('admin') == [admin.id]
+    assert not [s for s in statements if 'FROM user' in s]
+
+    login(client, admin)
+    client.post('/admin/users/new', data={
+        'username': 'boss', 'email': 'boss@example.com', 'password': 'secret123', 'role': 'admin'
+    })
+    boss = User.query.filter_by(username='boss').one()
+    assert role_member_ids('admin') == [admin.id, boss.id]
+
+    client.post(f'/admin/users/{agent.id}/edit', data={
+        'username': 'agent', 'email': 'agent@example.com', 'role': 'admin'
+    })
+    assert role_member_ids('admin') == [admin.id, agent.id, boss.id]
+    client.post(f'/admin/users/{boss.id}/delete')
+    assert role_member_ids('admin', 'agent') == [admin.id, agent.id]
+
+    # Another worker changing membership commits a new version token
+    with db.engine.begin() as connection:
+        connection.execute(db.update(User.__table__).where(User.id == agent.id).values(role='user'))
+        connection.execute(db.update(CacheVersion.__table__).values(token='other-worker'))
+    db.session.rollback()
+    assert role_member_ids('admin', 'agent') == [admin.id]
+
+
+def test_messages_render_from_type_and_current_ticket(client, category):
+    """Rows store parameters, not text, so a renamed ticket shows its new subject"""
+    author = make_user('customer')
+    agent = make_user('agent', 'agent')
+    ticket = make_ticket(author, category, subject='Printer on fire')
+    ticket.assigned_to = agent.id
+    db.session.commit()
+    add_comment(ticket, author)
+    create_notification(author.id, ticket.id, 'status_changed', old_status='open', new_status='in_progress')
+    db.session.commit()
+
+    assert {n.stored_message for n in Notification.query} == {''}
+    ticket.subject = 'Printer fixed'
+    db.session.commit()
+
+    login(client, agent)
+    [comment] = client.get('/api/notifications').get_json()['notifications']
+    assert comment['message'] == 'New comment on assigned ticket "Printer fixed" by customer'
+    [status] = fetch_notifications(author)[0]
+    assert status.message == 'Your ticket "Printer fixed" status changed from Open to In Progress'
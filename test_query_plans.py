@@ -0,0 +1,33 @@
+from app import app as flask_app, db, ticket_query_plans, plan_problems
+
+
+def test_ticket_queries_use_indexes(app):
+    """No dashboard, stats or relationship query reads the whole ticket table"""
+    results = ticket_query_plans()
+    assert {name for name, _, _, _ in results} >= {'dashboard', 'dashboard by status', 'customer dashboard', 'ticket stats'}
+    failures = [f'{name}: {problems}\n{statement}' for name, statement, _, problems in results if problems]
+    assert not failures, '\n\n'.join(failures)
+
+
+def test_missing_index_is_reported(app):
+    with db.engine.begin() as connection:
+        connection.exec_driver_sql('DROP INDEX ix_attachment_ticket')
+    problems = {name: problems for name, _, _, problems in ticket_query_plans() if problems}
+    assert problems['dashboard'] == ['SCAN attachment']
+    assert problems['ticket attachments'] == ['SCAN attachment']
+
+
+def test_check_command_creates_missing_indexes(app):
+    """The command upgrades the schema first, so it checks the indexes the models declare"""
+    with db.engine.begin() as connection:
+        connection.exec_driver_sql('DROP INDEX ix_ticket_status_updated')
+    result = flask_app.test_cli_runner().invoke(args=['check-query-plans'])
+    assert result.exit_code == 0, result.output
+    assert 'All ticket query plans use indexes' in result.output
+
+
+def test_plan_problems():
+    assert plan_problems(['SCAN ticket', 'SEARCH user USING INTEGER PRIMARY KEY (rowid=?)']) == ['SCAN ticket']
+    assert plan_problems(['SCAN ticket USING INDEX ix_ticket_updated']) == []
+    assert plan_problems(['SEARCH ticket USING INDEX x (user_id=?)', 'USE TEMP B-TREE FOR ORDER BY']) == ['USE TEMP B-TREE FOR ORDER BY']
+    assert plan_problems(['USE TEMP B-TREE FOR ORDER BY'], allowed=('USE TEMP B-TREE',)) == []
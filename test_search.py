@@ -0,0 +1,218 @@
+import io
+import re
+
+import app as app_module
+from app import db, Ticket, Comment, create_ticket_search
+from conftest import make_user, make_ticket, login, capture_statements
+
+
+def search(client, text, **params):
+    """Ticket ids on the dashboard for a search, in display order"""
+    response = client.get('/dashboard', query_string=dict(params, search=text))
+    assert response.status_code == 200
+    return [int(ticket_id) for ticket_id in re.findall(rb'#(\d+) - ', response.data)]
+
+
+def test_search_covers_comments_and_ranks_subject_matches_first(client, category):
+    """Matches are ranked by BM25 with the subject weighted highest"""
+    author = make_user('customer')
+    agent = make_user('agent', 'agent')
+    in_comment = make_ticket(author, category, subject='Cannot log in')
+    in_subject = make_ticket(author, category, subject='Printer jammed')
+    unrelated = make_ticket(author, category, subject='Password reset')
+    db.session.add(Comment(content='The printer in room 4 shows the same error', user_id=agent.id, ticket_id=in_comment.id))
+    db.session.commit()
+    login(client, agent)
+
+    with capture_statements() as statements:
+        assert search(client, 'printer') == [in_subject.id, in_comment.id]
+    assert any('MATCH' in s for s in statements)
+    assert not any('LIKE' in s for s in statements)
+
+    # Words match as prefixes, and punctuation can't break the FTS query
+    assert search(client, 'print"') == [in_subject.id, in_comment.id]
+    assert search(client, 'passw') == [unrelated.id]
+    assert search(client, '!!!') == []
+    in_comment.status = 'in_progress'
+    db.session.commit()
+    assert search(client, 'printer', sort='recent') == [in_comment.id, in_subject.id]
+
+
+def test_relevance_is_only_the_selected_sort_while_searching(client, category):
+    agent = make_user('agent', 'agent')
+    login(client, agent)
+
+    selected = rb'<option value="(\w+)" selected>'
+    assert re.findall(selected, client.get('/dashboard').data) == [b'recent']
+    assert re.findall(selected, client.get('/dashboard?sort=relevance').data) == [b'recent']
+    assert re.findall(selected, client.get('/dashboard?search=printer').data) == [b'relevance']
+    assert re.findall(selected, client.get('/dashboard?queue=unassigned').data) == [b'priority']
+
+
+def test_search_index_follows_edits_and_deletes(client, category):
+    author = make_user('customer')
+    agent = make_user('agent', 'agent')
+    ticket = make_ticket(author, category, subject='Printer jammed')
+    comment = Comment(content='Replaced the toner', user_id=agent.id, ticket_id=ticket.id)
+    db.session.add(comment)
+    db.session.commit()
+    login(client, agent)
+    assert search(client, 'toner') == [ticket.id]
+
+    ticket.subject = 'Scanner jammed'
+    db.session.delete(comment)
+    db.session.commit()
+    assert search(client, 'printer') == []
+    assert search(client, 'toner') == []
+    assert search(client, 'scanner') == [ticket.id]
+
+    db.session.delete(ticket)
+    db.session.commit()
+    assert search(client, 'scanner') == []
+
+
+def test_search_respects_ticket_visibility(client, category):
+    """Customers only find their own tickets"""
+    customer = make_user('customer')
+    other = make_user('other')
+    own = make_ticket(customer, category, subject='Printer jammed')
+    make_ticket(other, category, subject='Printer on fire')
+    login(client, customer)
+
+    assert search(client, 'printer') == [own.id]
+
+
+def test_existing_tickets_are_indexed_when_the_index_is_added(app, category):
+    author = make_user('customer')
+    ticket = make_ticket(author, category, subject='Printer jammed')
+    with db.engine.begin() as connection:
+        connection.execute(db.text('DROP TABLE ticket_search'))
+        create_ticket_search(Comment.__table__, connection)
+
+    query, _ = app_module.search_tickets(Ticket.query, 'printer')
+    assert query.all() == [ticket]
+
+
+def test_index_created_with_older_options_is_rebuilt(app, category):
+    author = make_user('customer')
+    ticket = make_ticket(author, category, subject='Printer jammed')
+    with db.engine.begin() as connection:
+        connection.execute(db.text('DROP TABLE ticket_search'))
+        connection.execute(db.text('CREATE VIRTUAL TABLE ticket_search USING fts5(subject, description, comments)'))
+        create_ticket_search(Comment.__table__, connection)
+        definition = connection.execute(db.text("SELECT sql FROM sqlite_master WHERE name = 'ticket_search'")).scalar()
+    assert "prefix = '2 3 4'" in definition
+
+    query, _ = app_module.search_tickets(Ticket.query, 'printer')
+    assert query.all() == [ticket]
+
+
+def test_other_databases_fall_back_to_like(client, category, monkeypatch):
+    author = make_user('customer')
+    agent = make_user('agent', 'agent')
+    ticket = make_ticket(author, category, subject='Cannot log in')
+    db.session.add(Comment(content='Printer error too', user_id=agent.id, ticket_id=ticket.id))
+    db.session.commit()
+    monkeypatch.setattr(app_module, 'ticket_search_enabled', lambda: False)
+    login(client, agent)
+
+    with capture_statements() as statements:
+        assert search(client, 'Printer') == [ticket.id]
+    assert any('LIKE' in s for s in statements)
+
+
+def suggest(client, text, **params):
+    response = client.get('/api/tickets/suggest', query_string=dict(params, q=text))
+    assert response.status_code == 200
+    return [suggestion['id'] for suggestion in response.get_json()['suggestions']]
+
+
+def test_suggestions_match_subject_prefixes_newest_first(client, category):
+    customer = make_user('customer')
+    agent = make_user('agent', 'agent')
+    jammed = make_ticket(customer, category, subject='Printer jammed')
+    toner = make_ticket(customer, category, subject='Printer out of toner')
+    make_ticket(customer, category, subject='Scanner offline')
+    in_description = make_ticket(customer, category, subject='Office equipment')
+    in_description.description = 'The printer is broken'
+    db.session.commit()
+    login(client, agent)
+
+    with capture_statements() as statements:
+        assert suggest(client, 'pri') == [toner.id, jammed.id]
+    assert any('MATCH' in s for s in statements)
+    assert suggest(client, 'printer ja') == [jammed.id]
+    assert suggest(client, 'pri', limit=1) == [toner.id]
+    # A one letter prefix would match most tickets, so it waits for more input
+    assert suggest(client, 'p') == []
+
+    # New tickets are suggested as soon as they are created
+    client.post('/ticket/new', data={
+        'subject': 'Printer on fire', 'description': 'Smoke', 'category_id': category.id, 'confirm_duplicate': '1'
+    })
+    new = Ticket.query.filter_by(subject='Printer on fire').one()
+    assert suggest(client, 'printer')[0] == new.id
+
+
+def test_suggestions_respect_ticket_visibility(client, category, monkeypatch):
+    customer = make_user('customer')
+    other = make_user('other')
+    own = make_ticket(customer, category, subject='Printer jammed')
+    make_ticket(other, category, subject='Printer on fire')
+    login(client, customer)
+
+    assert suggest(client, 'printer') == [own.id]
+    monkeypatch.setattr(app_module, 'ticket_search_enabled', lambda: False)
+    assert suggest(client, 'printer') == [own.id]
+
+
+def duplicates(client, subject, description=''):
+    response = client.get('/api/tickets/duplicates', query_string={'subject': subject, 'description': description})
+    assert response.status_code == 200
+    return [duplicate['id'] for duplicate in response.get_json()['duplicates']]
+
+
+def test_similar_open_tickets_are_flagged_as_duplicates(client, category):
+    """Tickets sharing the rarer words score highest; closed tickets are left out"""
+    customer = make_user('customer')
+    other = make_user('other')
+    printer = make_ticket(customer, category, subject='Office printer shows paper jam error')
+    make_ticket(customer, category, subject='Office wifi keeps dropping')
+    closed = make_ticket(customer, category, subject='Office printer paper jam again')
+    closed.status = 'closed'
+    make_ticket(other, category, subject='Printer paper jam in office')
+    db.session.commit()
+    login(client, customer)
+
+    with capture_statements() as statements:
+        assert duplicates(client, 'Paper jam error on office printer') == [printer.id]
+    assert any('MATCH' in s for s in statements)
+    assert duplicates(client, 'Cannot open email attachments') == []
+    # Words that no ticket contains don't hide the ones that match
+    assert duplicates(client, 'Printer shows paper jam error', 'Xyzzy plugh frobnicate quux') == [printer.id]
+
+    # New tickets are matched as soon as they are created
+    scanner = make_ticket(customer, category, subject='Scanner stuck on calibration')
+    assert duplicates(client, 'Scanner calibration stuck') == [scanner.id]
+
+
+def test_submitting_a_likely_duplicate_asks_for_confirmation(client, category):
+    customer = make_user('customer')
+    existing = make_ticket(customer, category, subject='Printer paper jam')
+    login(client, customer)
+    form = {'subject': 'Paper jam in printer', 'description': 'Again', 'category_id': category.id}
+
+    response = client.post('/ticket/new', data=form)
+    assert response.status_code == 200
+    assert f'#{existing.id} Printer paper jam'.encode() in response.data
+    assert b'name="confirm_duplicate"' in response.data
+    assert b'value="Paper jam in printer"' in response.data
+    assert Ticket.query.count() == 1
+
+    # Uploads can't be carried over, so the form asks for them again
+    response = client.post('/ticket/new', data=dict(form, attachments=(io.BytesIO(b'log'), 'printer.log')))
+    assert b'Attach printer.log again' in response.data
+
+    response = client.post('/ticket/new', data=dict(form, confirm_duplicate='1'))
+    assert response.status_code == 302
+    assert Ticket.query.count() == 2